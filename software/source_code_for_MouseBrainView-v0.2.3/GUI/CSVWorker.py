@@ -6,40 +6,57 @@
 # Mouse Brain View
 #-------------------------------------------------------------------------------
 
-from PyQt5.QtCore import (
-	QObject, pyqtSignal
-)
 from datetime import datetime
-from queue import Queue
-import time
+import numpy as np
 
 import csv
 
-class CSVWorker(QObject):
-	finished = pyqtSignal()
+from RecordWorker import RecordWorker
 
-	def __init__(self, queue, dirname, parent=None):
-		super(CSVWorker, self).__init__(parent)
-		self.qq = queue
-		self.running = True
+class CSVWorker(RecordWorker):
+	def __init__(self, dirname, meta, parent=None, **kwargs):
+		super(CSVWorker, self).__init__(parent=parent, **kwargs)
+		self.ofile = None
 		
 		try:
 			now = datetime.now()
 			dirname.mkdir(exist_ok=True)
 			fname = dirname / now.strftime("data_%Y-%m-%d_%H-%M-%S.csv")
+			self.gaps_fname = fname.with_name(fname.stem + '_gaps.csv')
+			# re-referenced data is float
+			self.fmt = '%d' if meta.get('dtype', '<u2') == '<u2' else '%.7g'
+			self.clock.nominal_rate = meta['sample_rate']
 			self.ofile = open(fname, 'w', newline='')
-			self.ocsv = csv.writer(self.ofile, quoting=csv.QUOTE_MINIMAL)
-		except (FileNotFoundError, FileExistsError) as e:
+			self.open_time_table(fname.with_name(fname.stem + '_time.csv'))
+			ocsv = csv.writer(self.ofile, quoting=csv.QUOTE_MINIMAL)
+			ocsv.writerow(['Sample rate',     meta['sample_rate']])
+			ocsv.writerow(['Low-pass',        '%g' % meta['low_pass']])
+			ocsv.writerow(['High-pass',       meta['high_pass']])
+			ocsv.writerow(['DSP enable',      meta['dsp_enable']])
+			ocsv.writerow(['DSP cutoff freq', meta['dsp_cutoff']])
+			if 'montage' in meta:
+				ocsv.writerow(['Montage', meta['montage']])
+			ocsv.writerow(meta['channels'])
+		except OSError as e:
+			self.discard_files()
 			self.running = False
 		
-	def run(self):
-		while self.running:
-			if not self.qq.empty():
-				values = self.qq.get()
-				self.ocsv.writerow(values)
-			else:
-				time.sleep(1)
-		else:
-			del self.ocsv
+	def write_blocks(self, blocks):
+		if self.ofile is None: return
+		# same line terminator as csv.writer
+		np.savetxt(self.ofile, np.concatenate(blocks), fmt=self.fmt, delimiter=',', newline='\r\n')
+	
+	def close(self):
+		if self.ofile is not None:
 			self.ofile.close()
-			self.finished.emit()
+			self.close_time_table()
+			self.write_gaps()
+	
+	# Gaps go to a separate file, only if there were any
+	def write_gaps(self):
+		if not self.gaps: return
+		with open(self.gaps_fname, 'w', newline='') as gaps_file:
+			ocsv = csv.writer(gaps_file, quoting=csv.QUOTE_MINIMAL)
+			ocsv.writerow(['Frame', 'Start', 'Duration, s', 'Lost frames'])
+			for gap in self.gaps:
+				ocsv.writerow([gap['frame'], gap['start'], gap['duration'], gap['lost_frames']])
@@ -0,0 +1,60 @@
+#-------------------------------------------------------------------------------
+# author:	Nikita Makarevich
+# email:	nikita.makarevich@spbpu.com
+# 2021
+#-------------------------------------------------------------------------------
+# Mouse Brain View
+#-------------------------------------------------------------------------------
+# Raw recording: interleaved little-endian uint16 frames in *.bin file,
+# settings and channel names in *.json sidecar with the same name.
+# Re-referenced data (see montage.py) is float32, the sidecar has its dtype.
+#-------------------------------------------------------------------------------
+
+from datetime import datetime
+import numpy as np
+import json
+
+from RecordWorker import RecordWorker
+
+class RawWorker(RecordWorker):
+	def __init__(self, dirname, meta, parent=None, **kwargs):
+		super(RawWorker, self).__init__(parent=parent, **kwargs)
+		self.ofile = None
+
+		try:
+			now = datetime.now()
+			dirname.mkdir(exist_ok=True)
+			fname = dirname / now.strftime("data_%Y-%m-%d_%H-%M-%S.bin")
+			self.meta_fname = fname.with_suffix('.json')
+			self.meta = dict(meta)
+			self.meta['data_file'] = fname.name
+			self.meta['dtype'] = meta.get('dtype', '<u2')
+			self.meta['n_channels'] = len(self.meta['channels'])
+			self.meta['start_time'] = now.isoformat()
+			self.meta['time_file'] = fname.stem + '_time.csv'
+			self.clock.nominal_rate = self.meta['sample_rate']
+			self.ofile = open(fname, 'wb', buffering=1 << 20)
+			self.open_time_table(fname.with_name(self.meta['time_file']))
+			self.write_meta()
+		except OSError as e:
+			self.discard_files()
+			self.running = False
+
+	def write_meta(self):
+		self.meta['n_frames'] = self.n_frames
+		self.meta['dropped_frames'] = self.dropped_frames
+		self.meta['gaps'] = self.gaps
+		self.meta.update(self.clock_info())
+		with open(self.meta_fname, 'w') as json_file:
+			json.dump(self.meta, json_file, indent=1)
+
+	def write_blocks(self, blocks):
+		if self.ofile is None: return
+		for block in blocks:
+			self.ofile.write(np.ascontiguousarray(block, dtype=self.meta['dtype']))
+
+	def close(self):
+		if self.ofile is not None:
+			self.ofile.close()
+			self.close_time_table()
+			self.write_meta()
@@ -0,0 +1,148 @@
+#-------------------------------------------------------------------------------
+# author:	Nikita Makarevich
+# email:	nikita.makarevich@spbpu.com
+# 2021
+#-------------------------------------------------------------------------------
+# Mouse Brain View
+#-------------------------------------------------------------------------------
+# Base class for file recorders.
+# Frames come in blocks of shape (n_rows, n_channels) through a bounded queue.
+# The worker thread waits on the queue and writes everything that has been
+# queued at once.
+# Blocks can carry the host time when they were received, a sparse frame
+# index -> time table is written next to the data file.
+#-------------------------------------------------------------------------------
+
+from PyQt5.QtCore import (
+	QObject, pyqtSignal
+)
+from queue import Queue, Empty, Full
+import csv
+import os
+
+from timestamps import SampleClock
+from tracing import tracer
+
+class RecordWorker(QObject):
+	finished = pyqtSignal()
+
+	# What to do with a new block when the queue is full
+	OVERFLOW_DROP  = 0 # discard the block and count it
+	OVERFLOW_BLOCK = 1 # wait for free space, never use it from the GUI thread
+
+	def __init__(self, queue_size=256, overflow=OVERFLOW_DROP, parent=None):
+		super(RecordWorker, self).__init__(parent)
+		self.qq = Queue(maxsize=queue_size)
+		self.overflow = overflow
+		self.running = True
+		self.n_frames = 0       # frames written
+		self.n_queued = 0       # frames accepted by put()
+		self.dropped_blocks = 0 # blocks lost on queue overflow
+		self.dropped_frames = 0
+		self.gaps = []          # see add_gap()
+		self.clock = SampleClock()
+		self.time_file = None
+		self.n_times = 0        # points of the clock table already written
+
+	# Returns False if the block was dropped.
+	# t - time.monotonic() when the block was received
+	def put(self, block, t=None):
+		try:
+			self.qq.put(block, block=(self.overflow == RecordWorker.OVERFLOW_BLOCK))
+			self.n_queued += len(block)
+			if t is not None:
+				self.clock.stamp(self.n_queued, t)
+			return True
+		except Full:
+			self.dropped_blocks += 1
+			self.dropped_frames += len(block)
+			return False
+
+	# Data lost before the next put(), e.g. while the connection was restored.
+	# start - wall clock time when the data stopped, duration - s,
+	# lost_frames - estimate from duration and sample rate
+	def add_gap(self, start, duration, lost_frames):
+		self.gaps.append({
+			'frame'       : self.n_queued, # first frame after the gap
+			'start'       : start,
+			'duration'    : round(duration, 3),
+			'lost_frames' : int(lost_frames),
+		})
+		self.clock.new_segment()
+
+	# Called by subclasses with the name of the table file
+	def open_time_table(self, fname):
+		self.time_file = open(fname, 'w', newline='')
+		self.time_csv = csv.writer(self.time_file)
+		self.time_csv.writerow(['Frame', 'Host time, s', 'Monotonic, s'])
+
+	# Frame is the number of frames written before the end of the block,
+	# host time is UNIX time taken from the monotonic clock
+	def write_times(self):
+		if self.time_file is None: return
+		points = self.clock.points[self.n_times:]
+		self.n_times += len(points)
+		for frame, t in points:
+			self.time_csv.writerow([frame, '%.6f' % self.clock.wall_time(t), '%.6f' % t])
+
+	def close_time_table(self):
+		if self.time_file is None: return
+		self.write_times()
+		self.time_file.close()
+		self.time_file = None
+
+	# Recording could not be started, the files opened so far are removed
+	# and ofile stays None
+	def discard_files(self):
+		for f in (self.ofile, self.time_file):
+			if f is None: continue
+			f.close()
+			try: os.remove(f.name)
+			except OSError: pass
+		self.ofile = None
+		self.time_file = None
+
+	# Clock estimates for the metadata
+	def clock_info(self):
+		rate = self.clock.rate()
+		drift = self.clock.drift_ppm()
+		return {
+			'effective_sample_rate' : None if rate is None else round(rate, 4),
+			'clock_drift_ppm'       : None if drift is None else round(drift, 1),
+		}
+
+	def queue_depth(self):
+		return self.qq.qsize()
+
+	def stop(self):
+		self.running = False
+
+	def run(self):
+		tracer.set_thread_name('recorder')
+		while True:
+			try:
+				blocks = [self.qq.get(timeout=0.2)]
+			except Empty:
+				if self.running: continue
+				else: break
+			# Take everything that is queued and write it in one go
+			while True:
+				try:
+					blocks.append(self.qq.get_nowait())
+				except Empty:
+					break
+			n = sum(len(b) for b in blocks)
+			t0 = tracer.begin()
+			self.write_blocks(blocks)
+			tracer.end('write_blocks', t0, n)
+			self.n_frames += n
+			self.write_times()
+		self.close()
+		self.finished.emit()
+
+	# To be implemented in subclasses
+	def write_blocks(self, blocks):
+		raise NotImplementedError
+
+	def close(self):
+		pass
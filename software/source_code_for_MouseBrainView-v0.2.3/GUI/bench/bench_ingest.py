@@ -0,0 +1,249 @@
+#-------------------------------------------------------------------------------
+# author:	Nikita Makarevich
+# email:	nikita.makarevich@spbpu.com
+# 2021
+#-------------------------------------------------------------------------------
+# Mouse Brain View
+#-------------------------------------------------------------------------------
+# Micro-benchmarks of the ingest path:
+#   assembler - FrameAssembler.feed, splitting the stream into frames
+#   ring      - RingBuffer.write of the assembled frames
+#   filter    - FilterBank.process, 1 Hz high-pass, low-pass at 0.3 of the
+#               sample rate, 50 Hz notch
+#   spikes    - SpikeDetector.process, noise estimate and peak search
+#   quality   - ChannelStats.add, per channel signal quality
+#   window    - Main_window.on_net_data, offscreen (needs build/MainForm.py)
+#   csv, raw  - CSVWorker / RawWorker writing the frames
+# Every stage runs for all combinations of chunk size and channel count, the
+# stages set up for the sample rate (RATE_STAGES) also for every sample rate.
+# Results are printed or saved as JSON. With --trace the pipeline spans are
+# on, to see their cost.
+# Example:
+#   python bench/bench_ingest.py --chunks 512,1460,65536 --out ingest.json
+#-------------------------------------------------------------------------------
+
+import sys
+import os
+import argparse
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+import numpy as np
+
+from benchutil import (
+	GUI_DIR,
+	synthetic_stream,
+	chunks,
+	latency_summary,
+	save_results,
+	int_list,
+)
+from frames import FrameAssembler
+from ringbuffer import RingBuffer
+from timestamps import SampleClock
+from tracing import tracer
+from filters import FilterBank, design
+from spikes import SpikeDetector
+from quality import ChannelStats
+
+# Widgets are deleted with the application, it is kept for all cases
+qt_app = None
+
+STAGES = ['assembler', 'ring', 'filter', 'spikes', 'quality', 'window', 'csv', 'raw']
+# Buffer sizes etc. depend on the sample rate
+RATE_STAGES = ['ring', 'filter', 'spikes', 'quality', 'window']
+
+# Each stage is a function which prepares the stage and returns step(chunk)
+def stage_assembler(n_channels, samplerate, meta):
+	fa = FrameAssembler(n_channels)
+	return fa.feed
+
+# one second of samples
+def stage_ring(n_channels, samplerate, meta):
+	fa = FrameAssembler(n_channels)
+	rb = RingBuffer(n_channels, samplerate)
+	def step(chunk):
+		rb.write(fa.feed(chunk))
+	return step
+
+def stage_filter(n_channels, samplerate, meta):
+	fa = FrameAssembler(n_channels)
+	fb = FilterBank(design(samplerate, 1.0, 0.3 * samplerate, 50), n_channels)
+	def step(chunk):
+		block = fa.feed(chunk)
+		if len(block):
+			fb.process(block)
+	return step
+
+def stage_spikes(n_channels, samplerate, meta):
+	fa = FrameAssembler(n_channels)
+	sd = SpikeDetector(n_channels, samplerate)
+	def step(chunk):
+		block = fa.feed(chunk)
+		if len(block):
+			sd.process(block, fa.frames - len(block))
+	return step
+
+def stage_quality(n_channels, samplerate, meta):
+	fa = FrameAssembler(n_channels)
+	cs = ChannelStats(n_channels, samplerate)
+	def step(chunk):
+		cs.add(fa.feed(chunk))
+	return step
+
+def stage_window(n_channels, samplerate, meta):
+	os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+	from PyQt5.QtWidgets import QApplication
+	from PyQt5.QtCore import QSettings
+	global qt_app
+	qt_app = QApplication.instance() or QApplication(sys.argv[:1])
+	import main
+	from client import MyClient
+	win = main.Main_window(None, QSettings('MouseBrainView', 'bench'))
+	win.plot_timer.stop()
+	# as if the device has reported them, so every part is sized for them
+	win.device_info = dict(win.device_info, ch_count=n_channels, samplerate=samplerate)
+	win.layout_from_device()
+	win.client.m_state = MyClient.STATE_FLOW
+	win.clock = SampleClock(samplerate)
+	meta['window'] = win # keep it alive
+	def step(chunk):
+		win.on_net_data(chunk, time.monotonic())
+	return step
+
+def stage_writer(cls):
+	def stage(n_channels, samplerate, meta):
+		tmp = tempfile.TemporaryDirectory()
+		meta['tmp'] = tmp
+		info = {
+			'sample_rate' : samplerate, 'low_pass' : 500.0, 'high_pass' : 20000,
+			'dsp_enable'  : False, 'dsp_cutoff' : '0: DIFF',
+			'channels'    : ["ch%d" % (i+1) for i in range(n_channels)],
+		}
+		worker = cls(Path(tmp.name), info)
+		meta['worker'] = worker
+		fa = FrameAssembler(n_channels)
+		def step(chunk):
+			block = fa.feed(chunk)
+			if len(block):
+				# same as RecordWorker.run, without the thread
+				worker.put(block, time.monotonic())
+				worker.write_blocks([worker.qq.get_nowait()])
+				worker.write_times()
+		return step
+	return stage
+
+def make_stage(name):
+	if name == 'assembler': return stage_assembler
+	if name == 'ring':      return stage_ring
+	if name == 'filter':    return stage_filter
+	if name == 'spikes':    return stage_spikes
+	if name == 'quality':   return stage_quality
+	if name == 'window':    return stage_window
+	if name == 'csv':
+		from CSVWorker import CSVWorker
+		return stage_writer(CSVWorker)
+	if name == 'raw':
+		from RawWorker import RawWorker
+		return stage_writer(RawWorker)
+
+def close_stage(meta):
+	if 'worker' in meta:
+		meta['worker'].close()
+	if 'tmp' in meta:
+		meta['tmp'].cleanup()
+
+# samplerates - rates the stage is set up for, the first one is used for
+# the stages which do not depend on it
+def run_case(stage, n_channels, chunk, n_frames, samplerates):
+	stream = synthetic_stream(n_frames, n_channels)
+	parts = chunks(stream, chunk)
+
+	# Timing pass
+	meta = {}
+	step = make_stage(stage)(n_channels, samplerates[0], meta)
+	durations = np.empty(len(parts))
+	t_start = time.perf_counter()
+	for i, part in enumerate(parts):
+		t0 = time.perf_counter()
+		step(part)
+		durations[i] = time.perf_counter() - t0
+	total = time.perf_counter() - t_start
+	close_stage(meta)
+
+	# Allocation pass, slower, so it is separate from timing
+	meta = {}
+	step = make_stage(stage)(n_channels, samplerates[0], meta)
+	n_probe = min(len(parts), 200)
+	peaks = np.empty(n_probe)
+	tracemalloc.start()
+	for i in range(n_probe):
+		tracemalloc.clear_traces() # also resets the peak
+		step(parts[i])
+		peaks[i] = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	close_stage(meta)
+
+	fps = n_frames / total
+	result = {
+		'stage'         : stage,
+		'channels'      : n_channels,
+		'samplerate'    : samplerates[0] if stage in RATE_STAGES else None,
+		'chunk_bytes'   : chunk,
+		'frames'        : n_frames,
+		'chunks'        : len(parts),
+		'frames_per_s'  : round(fps, 1),
+		'mbytes_per_s'  : round(len(stream) / total / 1e6, 2),
+		'chunk_latency' : latency_summary(durations),
+		'alloc_peak_bytes_per_chunk' : {
+			'mean' : int(peaks.mean()),
+			'max'  : int(peaks.max()),
+		},
+		# how many times faster than the device produces data
+		'realtime_factor' : {str(fs) : round(fps / fs, 1) for fs in samplerates},
+	}
+	return result
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Ingest path micro-benchmarks')
+	parser.add_argument('--stages', default=','.join(STAGES), help='default: %(default)s')
+	parser.add_argument('--chunks', type=int_list, default=[256, 1460, 8192, 65536], help='chunk sizes, bytes')
+	parser.add_argument('--channels', type=int_list, default=[16, 32])
+	parser.add_argument('--samplerates', type=int_list, default=[125, 250, 500, 1000])
+	parser.add_argument('--frames', type=int, default=100000, help='frames per case')
+	parser.add_argument('--trace', action='store_true', help='enable timing spans')
+	parser.add_argument('--out', help='JSON file, stdout by default')
+	args = parser.parse_args(argv)
+	tracer.enable(args.trace)
+
+	stages = [s for s in args.stages.split(',') if s]
+	if 'window' in stages and not (GUI_DIR / 'build' / 'MainForm.py').exists():
+		print('build/MainForm.py not found, run "make MainForm.py" in build/, skipping "window"', file=sys.stderr)
+		stages.remove('window')
+
+	results = []
+	for stage in stages:
+		# one case per sample rate, or one for all of them
+		if stage in RATE_STAGES:
+			rates = [[fs] for fs in args.samplerates]
+		else:
+			rates = [args.samplerates]
+		for n_channels in args.channels:
+			for samplerates in rates:
+				for chunk in args.chunks:
+					r = run_case(stage, n_channels, chunk, args.frames, samplerates)
+					print('%-9s ch=%-3d fs=%-5s chunk=%-6d %12.0f frames/s  p99 %8.1f us' % (
+						stage, n_channels, r['samplerate'] or '-', chunk, r['frames_per_s'], r['chunk_latency']['p99_us']), file=sys.stderr)
+					results.append(r)
+	save_results(args.out, 'ingest', results, {
+		'frames' : args.frames,
+		'chunks' : args.chunks,
+		'channels' : args.channels,
+		'samplerates' : args.samplerates,
+		'trace' : args.trace,
+	})
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,174 @@
+#-------------------------------------------------------------------------------
+# author:	Nikita Makarevich
+# email:	nikita.makarevich@spbpu.com
+# 2021
+#-------------------------------------------------------------------------------
+# Mouse Brain View
+#-------------------------------------------------------------------------------
+# Render cost benchmark of the plot views.
+# Runs with offscreen Qt platform. Synthetic data is written into the ring
+# buffer by a timer at the given sample rate, the view is updated and
+# repainted at the given refresh rate, like in Main_window. The raster view
+# gets random spikes at SPIKE_RATE on every channel.
+# Reported per case:
+#   frame_ms        - set_data(), scene updates and synchronous repaint
+#   setdata_us_per_curve - set_data() time divided by channel count
+#   loop_latency_ms - how late a 5 ms probe timer fires
+# Example:
+#   python bench/bench_render.py --windows 100,1000,10000 --out render.json
+#-------------------------------------------------------------------------------
+
+import sys
+import os
+import argparse
+import time
+import numpy as np
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from benchutil import (
+	synthetic_stream,
+	latency_summary,
+	save_results,
+	int_list,
+)
+from PyQt5.QtCore import QTimer, QEventLoop
+from PyQt5.QtWidgets import QApplication
+import pyqtgraph as pg
+
+from ringbuffer import RingBuffer
+from spikes import SpikeBuffer, SPIKE_DTYPE
+import plotview
+
+SPIKE_RATE = 20 # spikes/s per channel
+
+# name : view(n_channels, spikes)
+VIEWS = {
+	'grid'    : lambda n, spikes: plotview.GridPlotView(n),
+	'stacked' : lambda n, spikes: plotview.StackedPlotView(n),
+	'heatmap' : lambda n, spikes: plotview.HeatmapView(n),
+	'raster'  : lambda n, spikes: plotview.SpikeRasterView(n, spikes),
+}
+
+# Spikes in rows start..start+n_rows, uniform in time and over the channels
+def random_spikes(rng, start, n_rows, n_channels, samplerate):
+	n = rng.poisson(SPIKE_RATE * n_channels * n_rows / samplerate)
+	spikes = np.empty(n, dtype=SPIKE_DTYPE)
+	spikes['index'] = np.sort(rng.integers(start, start + n_rows, n))
+	spikes['channel'] = rng.integers(0, n_channels, n)
+	spikes['amplitude'] = -100
+	return spikes
+
+def run_case(app, view_name, n_channels, n_samples, samplerate, fps, seconds, size):
+	frames = np.frombuffer(synthetic_stream(samplerate * 2, n_channels), dtype='<u2').reshape(-1, n_channels)
+	rb = RingBuffer(n_channels, n_samples)
+	rb.write(frames) # start with full window
+	rng = np.random.default_rng(0)
+	spikes = SpikeBuffer()
+	spikes.add(random_spikes(rng, 0, rb.count, n_channels, samplerate))
+
+	t_create = time.perf_counter()
+	view = VIEWS[view_name](n_channels, spikes)
+	view.resize(*size)
+	view.show()
+	app.processEvents()
+	t_create = time.perf_counter() - t_create
+
+	feed_period = 0.01
+	feed_rows = max(1, int(samplerate * feed_period))
+	state = {'pos' : 0, 'probe_t' : None}
+	frame_times = []
+	setdata_times = []
+	probe_delays = []
+
+	def feed():
+		pos = state['pos']
+		if pos + feed_rows > len(frames): pos = 0
+		spikes.add(random_spikes(rng, rb.count, feed_rows, n_channels, samplerate))
+		rb.write(frames[pos:pos + feed_rows])
+		state['pos'] = pos + feed_rows
+
+	def render():
+		t0 = time.perf_counter()
+		view.set_data(rb.view(), rb.count - rb.n_samples, samplerate)
+		t1 = time.perf_counter()
+		# deliver scene change notifications and paint now, not later in the loop
+		app.sendPostedEvents()
+		view.repaint()
+		t2 = time.perf_counter()
+		setdata_times.append(t1 - t0)
+		frame_times.append(t2 - t0)
+
+	probe_period = 0.005
+	def probe():
+		now = time.perf_counter()
+		if state['probe_t'] is not None:
+			probe_delays.append(max(0.0, now - state['probe_t'] - probe_period))
+		state['probe_t'] = now
+
+	timers = []
+	for period, fn in ((feed_period, feed), (1.0 / fps, render), (probe_period, probe)):
+		t = QTimer()
+		t.timeout.connect(fn)
+		t.start(int(round(period * 1000)))
+		timers.append(t)
+
+	loop = QEventLoop()
+	QTimer.singleShot(int(seconds * 1000), loop.quit)
+	loop.exec_()
+	for t in timers: t.stop()
+	view.close()
+	view.deleteLater()
+	app.processEvents()
+
+	frame = latency_summary(frame_times)
+	setdata = np.asarray(setdata_times) / n_channels
+	return {
+		'view'           : view_name,
+		'channels'       : n_channels,
+		'window_samples' : n_samples,
+		'samplerate'     : samplerate,
+		'target_fps'     : fps,
+		'achieved_fps'   : round(len(frame_times) / seconds, 1),
+		'create_ms'      : round(t_create * 1000, 1),
+		'frame_ms'       : {k.replace('_us', '_ms') : round(v / 1000, 3) for k, v in frame.items()},
+		'setdata_us_per_curve' : latency_summary(setdata),
+		'loop_latency_ms' : {k.replace('_us', '_ms') : round(v / 1000, 3) for k, v in latency_summary(probe_delays).items()},
+	}
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Plot view render benchmark (offscreen)')
+	parser.add_argument('--views', default=','.join(VIEWS), help='default: %(default)s')
+	parser.add_argument('--channels', type=int_list, default=[16, 32])
+	parser.add_argument('--windows', type=int_list, default=[100, 1000, 10000], help='window lengths, samples')
+	parser.add_argument('--samplerate', type=int, default=1000)
+	parser.add_argument('--fps', type=int, default=30)
+	parser.add_argument('--seconds', type=float, default=3.0, help='per case')
+	parser.add_argument('--size', type=int_list, default=[1600, 900], help='widget size, W,H')
+	parser.add_argument('--out', help='JSON file, stdout by default')
+	args = parser.parse_args(argv)
+
+	app = QApplication.instance() or QApplication(sys.argv[:1])
+	pg.setConfigOption('background', 'w')
+	pg.setConfigOption('foreground', 'k')
+
+	results = []
+	for view_name in [v for v in args.views.split(',') if v]:
+		for n_channels in args.channels:
+			for n_samples in args.windows:
+				r = run_case(app, view_name, n_channels, n_samples, args.samplerate, args.fps, args.seconds, args.size)
+				print('%-8s ch=%-3d window=%-6d frame p50 %7.2f ms  p99 %7.2f ms  fps %5.1f' % (
+					view_name, n_channels, n_samples,
+					r['frame_ms'].get('p50_ms', 0), r['frame_ms'].get('p99_ms', 0), r['achieved_fps']), file=sys.stderr)
+				results.append(r)
+	save_results(args.out, 'render', results, {
+		'samplerate' : args.samplerate,
+		'fps'        : args.fps,
+		'seconds'    : args.seconds,
+		'size'       : args.size,
+		'platform'   : os.environ.get('QT_QPA_PLATFORM'),
+	})
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,81 @@
+#-------------------------------------------------------------------------------
+# author:	Nikita Makarevich
+# email:	nikita.makarevich@spbpu.com
+# 2021
+#-------------------------------------------------------------------------------
+# Mouse Brain View
+#-------------------------------------------------------------------------------
+# Common helpers for benchmarks
+#-------------------------------------------------------------------------------
+
+import sys
+import json
+import time
+import platform
+from pathlib import Path
+import numpy as np
+
+GUI_DIR = Path(__file__).resolve().parent.parent
+if str(GUI_DIR) not in sys.path:
+	sys.path.insert(0, str(GUI_DIR))
+
+# Byte stream of n_frames interleaved uint16 frames, looks like real data
+def synthetic_stream(n_frames, n_channels, seed=0):
+	rng = np.random.RandomState(seed)
+	x = 32768 + 2000 * np.sin(np.arange(n_frames)[:, None] * 0.01 + np.arange(n_channels)[None, :])
+	x += rng.normal(0, 100, (n_frames, n_channels))
+	return np.clip(x, 0, 65535).astype('<u2').tobytes()
+
+# Split stream into chunks of the given size, not aligned to frames
+def chunks(stream, chunk):
+	view = memoryview(stream)
+	return [view[i:i + chunk] for i in range(0, len(stream), chunk)]
+
+# Durations in seconds -> summary in microseconds
+def latency_summary(durations):
+	d = np.asarray(durations) * 1e6
+	if len(d) == 0:
+		return {}
+	p50, p90, p99 = np.percentile(d, [50, 90, 99])
+	return {
+		'p50_us' : round(float(p50), 2),
+		'p90_us' : round(float(p90), 2),
+		'p99_us' : round(float(p99), 2),
+		'max_us' : round(float(d.max()), 2),
+	}
+
+def environment():
+	env = {
+		'time'     : time.strftime('%Y-%m-%d %H:%M:%S'),
+		'python'   : platform.python_version(),
+		'numpy'    : np.__version__,
+		'platform' : platform.platform(),
+		'machine'  : platform.machine(),
+	}
+	try:
+		from PyQt5.QtCore import QT_VERSION_STR, PYQT_VERSION_STR
+		env['qt'] = QT_VERSION_STR
+		env['pyqt'] = PYQT_VERSION_STR
+		import pyqtgraph
+		env['pyqtgraph'] = pyqtgraph.__version__
+	except ImportError:
+		pass
+	return env
+
+def save_results(fname, name, results, params):
+	data = {
+		'benchmark'   : name,
+		'environment' : environment(),
+		'params'      : params,
+		'results'     : results,
+	}
+	if fname:
+		with open(fname, 'w') as json_file:
+			json.dump(data, json_file, indent=1)
+	else:
+		json.dump(data, sys.stdout, indent=1)
+		print()
+
+# Comma separated list of ints for argparse
+def int_list(s):
+	return [int(v) for v in s.split(',') if v]
@@ -10,12 +10,163 @@
 #-------------------------------------------------------------------------------
 
 import socket
+import select
+import errno
+import os
+import time
+from queue import Queue, Empty, Full
+from concurrent.futures import Future
 
 from PyQt5.QtCore import (
-	QObject, QTimer,
+	QObject, QThread,
 	pyqtSignal, pyqtProperty, pyqtSlot
 )
 
+from device import DeviceState
+from tracing import tracer
+
+# Command sequences of the base station protocol
+INFO_COMMANDS       = ['`ver;', '`get-samplerate;', '`get-ch_count;', '`get-status;']
+STREAM_ON_COMMANDS  = ['`get-status;', '`exec-stream_on;']
+STREAM_OFF_COMMANDS = ['`exec-stream_off;']
+
+# Device parameters as (name, value) pairs in the order they are set
+# samplerate in Hz, low_pass in Hz (device takes mHz), high_pass in Hz
+def settings_params(samplerate, low_pass, high_pass, dsp_en, dsp_code):
+	return [
+		('samplerate', int(samplerate)),
+		('low_bw',     int(round(float(low_pass) * 1000))),
+		('high_bw',    int(high_pass)),
+		('dsp_en',     int(1 if dsp_en else 0)),
+		('dsp_code',   int(dsp_code)),
+	]
+
+# Data port opens some time after stream_on, connect is retried until timeout
+DAT_CONNECT_TIMEOUT = 5.0 # s
+DAT_RETRY_MIN = 0.02      # s, first pause, doubled after every attempt
+DAT_RETRY_MAX = 0.2       # s
+
+# Automatic reconnect after a connection loss, pause is doubled every attempt
+RECONNECT_MIN = 0.5       # s
+RECONNECT_MAX = 10.0      # s
+# Data socket timeouts in a row (1 s each) which mean the connection is lost
+RECONNECT_TIMEOUTS = 3
+
+# Replies end with ';'. Status reply is '>status:' and "name:value;" fields,
+# it is over when all STATUS_FIELDS are there or the next reply has started.
+STATUS_PREFIX = b'>status:'
+STATUS_FIELDS = ['samplerate', 'low_bw', 'high_bw', 'dsp_en', 'dsp_code']
+
+# Command port worker
+# Runs connects and commands one by one in its own thread, so the GUI never
+# waits for the device. Every submitted job returns a Future.
+# Done callbacks of the futures are called in the worker thread.
+class CommandWorker(QThread):
+	def __init__(self, parent=None):
+		super(CommandWorker, self).__init__(parent)
+		self.jobs = Queue()
+		self.running = False
+
+	def submit(self, fn, *args):
+		future = Future()
+		self.jobs.put((future, fn, args))
+		if not self.isRunning():
+			self.running = True
+			self.start()
+		return future
+
+	def run(self):
+		tracer.set_thread_name('commands')
+		while self.running:
+			try:
+				future, fn, args = self.jobs.get(timeout=0.2)
+			except Empty:
+				continue
+			if not future.set_running_or_notify_cancel():
+				continue
+			t0 = tracer.begin()
+			try:
+				future.set_result(fn(*args))
+			except Exception as e:
+				future.set_exception(e)
+			tracer.end(fn.__name__.lstrip('_'), t0)
+
+	# Cancel jobs which have not started yet
+	def cancel_pending(self):
+		while True:
+			try:
+				future, fn, args = self.jobs.get_nowait()
+			except Empty:
+				return
+			future.cancel()
+
+	def stop(self):
+		self.cancel_pending()
+		self.running = False
+		self.wait()
+
+# Data port reader
+# Runs in its own thread and owns the data socket while the flow is active.
+# Each recv_into() fills one of the preallocated buffers, the filled part is
+# handed to the GUI through a bounded queue. A buffer is reused only after
+# the consumer has taken at least one newer block from the queue, so the
+# consumer must finish with a block before it takes the next one.
+# Blocks are stamped with time.monotonic() right after they are received.
+class DataReader(QThread):
+	data_ready = pyqtSignal()
+	error_signal = pyqtSignal(socket.error)
+
+	def __init__(self, sock, block_size=65536, queue_size=64, parent=None):
+		super(DataReader, self).__init__(parent)
+		self.sock = sock
+		self.queue = Queue(maxsize=queue_size)
+		self.buffers = [bytearray(block_size) for i in range(queue_size + 2)]
+		self.running = False
+
+	def run(self):
+		tracer.set_thread_name('reader')
+		self.running = True
+		n_buf = 0
+		while self.running:
+			buf = self.buffers[n_buf]
+			try:
+				# span includes the wait for data
+				t0 = tracer.begin()
+				n = self.sock.recv_into(buf)
+				tracer.end('recv', t0, n)
+				if n == 0:
+					raise socket.error(errno.ECONNRESET, os.strerror(errno.ECONNRESET))
+			except socket.timeout as e:
+				if self.running: self.error_signal.emit(e)
+				continue
+			except socket.error as e:
+				# socket is shut down on purpose when the flow is stopped
+				if self.running: self.error_signal.emit(e)
+				break
+			t = time.monotonic()
+			# Wait for free space rather than drop data, TCP will throttle the sender
+			block = memoryview(buf)[:n]
+			while self.running:
+				try:
+					self.queue.put((block, t), timeout=0.1)
+					self.data_ready.emit()
+					break
+				except Full:
+					pass
+			n_buf = (n_buf + 1) % len(self.buffers)
+		self.running = False
+
+	def stop(self):
+		self.running = False
+
+	# Take all (block, time) pairs that are ready at the moment
+	def blocks(self):
+		while True:
+			try:
+				yield self.queue.get_nowait()
+			except Empty:
+				return
+
 # TCP client
 class MyClient(QObject):
 	STATE_DISCONNECTED   = 0
@@ -35,7 +186,8 @@ class MyClient(QObject):
 	flow_changed = pyqtSignal(bool)
 	
 	command_signal = pyqtSignal(str)
-	data_signal    = pyqtSignal(bytes)
+	device_changed = pyqtSignal(dict) # DeviceState.as_dict()
+	data_signal    = pyqtSignal(object, float) # block, receive time (monotonic)
 	connection_error_signal = pyqtSignal(socket.error)
 
 	def __init__(self, parent=None):
@@ -50,16 +202,57 @@ class MyClient(QObject):
 		self.socket_com = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		self.socket_dat = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		
-		self.timer=QTimer()
-		self.timer.timeout.connect(self.rx_data)
-		self.timer.setSingleShot(True)
-		self.timer.setInterval(1) # 1ms
+		self.reader = None
+		self.worker = CommandWorker(self)
+		# filled from the replies, it is written in the worker thread
+		self.device = DeviceState()
 	
+	# All connects and commands go through the worker, they return Future
 	@pyqtSlot()
 	def connect_to_host_com(self):
+		return self.worker.submit(self._connect_com)
+	
+	# timeout - how long to wait for the data port to open, s
+	@pyqtSlot()
+	def connect_to_host_dat(self, timeout=DAT_CONNECT_TIMEOUT):
+		return self.worker.submit(self._connect_dat, timeout)
+	
+	def command(self, line):
+		return self.worker.submit(self._command, line)
+	
+	# Commands are sent at once, result is the list of replies
+	def commands(self, lines):
+		return self.worker.submit(self._commands, list(lines))
+	
+	# Set and apply only the parameters which differ from the device state,
+	# params - list of (name, value), see settings_params()
+	def configure(self, params):
+		return self.worker.submit(self._configure, list(params))
+	
+	# Disconnect goes after the commands already queued (e.g. stream_off)
+	@pyqtSlot()
+	def disconnect_from_host(self):
+		self.flow_stop()
+		return self.worker.submit(self._disconnect)
+	
+	# Stop the worker thread, call before the client is destroyed
+	def close(self):
+		if self.state >= MyClient.STATE_COM_CONNECTED:
+			try: self.disconnect_from_host().result(timeout=10)
+			except Exception: pass
+		self.worker.stop()
+	
+	#---------------------------------------------------------------------------#
+	# Jobs, they run in the worker thread
+	#---------------------------------------------------------------------------#
+	def _connect_com(self):
 		self.socket_com = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		self.socket_com.settimeout(1.0) # 1s
 		self.com_writer_obj = self.socket_com.makefile(mode='wb')
+		self.com_rx = b''
+		# device could be changed while we were away
+		self.device.clear()
+		self.device_changed.emit(self.device.as_dict())
 		
 		self.state = MyClient.STATE_COM_CONNECTING
 		try:
@@ -69,64 +262,169 @@ class MyClient(QObject):
 			print('connect to command port: timeout')
 			self.state = MyClient.STATE_DISCONNECTED
 			self.connection_error_signal.emit(e)
+			raise
 	
-	@pyqtSlot()
-	def connect_to_host_dat(self):
-		self.socket_dat = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-		self.socket_dat.settimeout(1.0)
+	def _connect_dat(self, timeout):
+		if self.state < MyClient.STATE_COM_CONNECTED:
+			raise socket.error(errno.ENOTCONN, os.strerror(errno.ENOTCONN))
 		self.state = MyClient.STATE_DAT_CONNECTING
-		try:
-			self.socket_dat.connect((self.m_hostname, self.m_port_dat))
-			self.state = MyClient.STATE_DAT_CONNECTED
-		except (socket.error, socket.timeout) as e:
-			print('connect to data port: timeout')
-			self.state = MyClient.STATE_DISCONNECTED
-			self.connection_error_signal.emit(e)
+		deadline = time.monotonic() + timeout
+		pause = DAT_RETRY_MIN
+		while True:
+			self.socket_dat = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+			self.socket_dat.settimeout(1.0)
+			try:
+				self.socket_dat.connect((self.m_hostname, self.m_port_dat))
+				break
+			except (socket.error, socket.timeout) as e:
+				self.socket_dat.close()
+				remaining = deadline - time.monotonic()
+				if remaining > 0:
+					time.sleep(min(pause, remaining))
+					pause = min(pause * 2, DAT_RETRY_MAX)
+					continue
+				print('connect to data port: timeout')
+				# without data port the session is over
+				self.state = MyClient.STATE_DISCONNECTED
+				self.socket_com.close()
+				self.connection_error_signal.emit(e)
+				raise
+		self.state = MyClient.STATE_DAT_CONNECTED
 	
-	@pyqtSlot()
-	def disconnect_from_host(self):
-		self.flow_stop()
-		if self.state >= MyClient.STATE_DAT_CONNECTED:
-			self.socket_dat.shutdown(socket.SHUT_RDWR)
-			self.socket_dat.close()
-		
-		if self.state >= MyClient.STATE_COM_CONNECTED:
-			self.socket_com.shutdown(socket.SHUT_RDWR)
-			self.socket_com.close()
-		
+	def _disconnect(self):
+		state = self.state
 		self.state = MyClient.STATE_DISCONNECTED
-		
+		# Shutdown also wakes up the reader if it waits on the socket
+		try:
+			if state >= MyClient.STATE_DAT_CONNECTED:
+				self.socket_dat.shutdown(socket.SHUT_RDWR)
+				self.socket_dat.close()
+			if self.reader is not None:
+				self.reader.wait()
+			
+			if state >= MyClient.STATE_COM_CONNECTED:
+				self.socket_com.shutdown(socket.SHUT_RDWR)
+				self.socket_com.close()
+		except socket.error:
+			pass
 	
-	def command(self, line):
-		if self.state >= MyClient.STATE_COM_CONNECTED:
-			try:
-				#self.socket_com.sendall(line.encode("ascii", "replace"))
-				self.com_writer_obj.write(line.encode("ascii", "replace"))
-				self.com_writer_obj.flush()
-				
-				reply = self.socket_com.recv(1024)
-				self.command_signal.emit(reply.decode("ascii"))
-			except socket.error as e:
+	def _command(self, line):
+		return self._commands([line])[0]
+	
+	# Pipelined: all lines go in one write, then replies are read in order
+	def _commands(self, lines):
+		if self.state < MyClient.STATE_COM_CONNECTED:
+			raise socket.error(errno.ENOTCONN, os.strerror(errno.ENOTCONN))
+		try:
+			self._drop_stale()
+			self.com_writer_obj.write(''.join(lines).encode("ascii", "replace"))
+			self.com_writer_obj.flush()
+			
+			replies = []
+			for line in lines:
+				reply = self._read_reply()
+				if self.device.parse(reply):
+					self.device_changed.emit(self.device.as_dict())
+				self.command_signal.emit(reply)
+				replies.append(reply)
+			return replies
+		except socket.error as e:
+			# socket is shut down on disconnect, it is not an error
+			if self.state >= MyClient.STATE_COM_CONNECTED:
 				self.connection_error_signal.emit(e)
-
+			raise
+	
+	def _configure(self, params):
+		changed = [(name, value) for name, value in params if getattr(self.device, name) != value]
+		if not changed:
+			return []
+		lines = ["`set-%s:%d;" % (name, value) for name, value in changed]
+		replies = self._commands(lines + ['`exec-apply;'])
+		applied = replies[-1] == '>apply:ok;'
+		for (name, value), reply in zip(changed, replies):
+			# if not applied, it is not known what the device runs now
+			self.device.set(name, value if applied and reply == '>%s:ok;' % name else None)
+		self.device_changed.emit(self.device.as_dict())
+		return replies
+	
+	# The rest after the reply is kept for the next reply
+	def _read_reply(self):
+		try:
+			end = self._reply_end()
+		except socket.timeout:
+			# a late reply would be taken for the next one, drop what has come
+			self.com_rx = b''
+			raise
+		reply, self.com_rx = self.com_rx[:end], self.com_rx[end:]
+		return reply.decode("ascii", "replace")
+	
+	# Length of the first reply in com_rx, reads until it is known
+	def _reply_end(self):
+		while self.com_rx.find(b';') < 0:
+			self._recv()
+		end = self.com_rx.find(b';') + 1
+		if not self.com_rx.startswith(STATUS_PREFIX):
+			return end
+		names = {self._field_name(self.com_rx[len(STATUS_PREFIX):end])}
+		while True:
+			pos = self.com_rx.find(b';', end)
+			if pos < 0:
+				if names.issuperset(STATUS_FIELDS) and len(self.com_rx) == end:
+					return end
+				# firmware may send fewer fields, then the reply ends with the timeout
+				try:
+					self._recv()
+				except socket.timeout:
+					return end
+				continue
+			segment = self.com_rx[end:pos]
+			# fields have no '>', errors ("not today;") have no ':'
+			if segment.startswith(b'>') or b':' not in segment:
+				return end
+			names.add(self._field_name(segment))
+			end = pos + 1
+	
+	@staticmethod
+	def _field_name(segment):
+		return segment.split(b':', 1)[0].decode("ascii", "replace")
+	
+	def _recv(self):
+		data = self.socket_com.recv(1024)
+		if len(data) == 0:
+			raise socket.error(errno.ECONNRESET, os.strerror(errno.ECONNRESET))
+		self.com_rx += data
+	
+	# Replies left from a command which has timed out
+	def _drop_stale(self):
+		while select.select([self.socket_com], [], [], 0)[0]:
+			self.com_rx = b''
+			self._recv()
+		self.com_rx = b''
+	
+	# Forward blocks from the reader thread, runs in the GUI thread
+	@pyqtSlot()
 	def rx_data(self):
-		if self.state >= MyClient.STATE_FLOW:
-			try:
-				reply = self.socket_dat.recv(65536)
-				if len(reply) != 0: self.data_signal.emit(reply)
-			except socket.error as e:
-				self.connection_error_signal.emit(e)
-			finally:
-				self.timer.start()
+		if self.reader is None: return
+		for block, t in self.reader.blocks():
+			if self.state >= MyClient.STATE_FLOW:
+				t0 = tracer.begin()
+				self.data_signal.emit(block, t)
+				tracer.end('rx_data', t0, len(block))
 
 	def flow_start(self):
 		if self.state >= MyClient.STATE_DAT_CONNECTED:
+			if self.reader is not None:
+				self.reader.wait()
+			self.reader = DataReader(self.socket_dat)
+			self.reader.data_ready.connect(self.rx_data)
+			self.reader.error_signal.connect(self.connection_error_signal)
 			self.state = MyClient.STATE_FLOW
-			self.timer.start()
+			self.reader.start()
 	def flow_stop(self):
 		if self.state >= MyClient.STATE_FLOW:
 			self.state = MyClient.STATE_DAT_CONNECTED
-		self.timer.stop()
+		if self.reader is not None:
+			self.reader.stop()
 	
 	@pyqtProperty(int, notify=state_changed)
 	def state(self):
@@ -160,14 +458,14 @@ class MyClient(QObject):
 	def port_com(self, port):
 		if self.m_port_com == port: return
 		self.m_port_com = port
-		self.port_changed.emit(port)
+		self.port_com_changed.emit(port)
 	
 	@pyqtProperty(int, notify=port_dat_changed)
 	def port_dat(self):
 		return self.m_port_dat
 	
-	@port_com.setter
+	@port_dat.setter
 	def port_dat(self, port):
 		if self.m_port_dat == port: return
 		self.m_port_dat = port
-		self.port_changed.emit(port)
+		self.port_dat_changed.emit(port)
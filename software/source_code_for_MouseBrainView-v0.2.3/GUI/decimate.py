@@ -0,0 +1,58 @@
+#-------------------------------------------------------------------------------
+# author:	Nikita Makarevich
+# email:	nikita.makarevich@spbpu.com
+# 2021
+#-------------------------------------------------------------------------------
+# Mouse Brain View
+#-------------------------------------------------------------------------------
+# Min/max decimation of the plot data.
+# Every bin of samples is replaced by its minimum and maximum, so peaks stay
+# visible while a curve gets no more points than there are pixels.
+#-------------------------------------------------------------------------------
+
+import numpy as np
+
+# Up to this many samples per bin min/max go element-wise over the bin,
+# numpy reduces a short last axis much slower
+SHORT_BIN = 16
+
+# data   - array (n_channels, n_samples)
+# pixels - width of the plot, the result has at most this many points
+# start  - absolute index of the first sample. Bin edges are kept at the
+#          same absolute positions, so the picture does not shimmer while
+#          the window scrolls.
+# Returns (x, y): sample positions relative to data[:, 0], shape (n_points,),
+# and values, shape (n_channels, n_points).
+def minmax_decimate(data, pixels, start=0):
+	n_samples = data.shape[1]
+	if n_samples <= max(pixels, 2):
+		return np.arange(n_samples), data
+	# one bin is kept for the latest, not completed one
+	n_bins = max(1, pixels // 2 - 1)
+	k = -(-n_samples // n_bins) # samples per bin, rounded up
+	skip = -start % k           # oldest samples before the first edge are left out
+	n_bins = (n_samples - skip) // k
+	end = skip + n_bins * k
+	n_out = n_bins + (end < n_samples)
+	y = np.empty((data.shape[0], 2 * n_out), dtype=data.dtype)
+	x = np.empty(2 * n_out)
+	bins = data[:, skip:end].reshape(data.shape[0], n_bins, k)
+	lo = y[:, 0:2 * n_bins:2]
+	hi = y[:, 1:2 * n_bins:2]
+	if k <= SHORT_BIN:
+		np.copyto(lo, bins[:, :, 0])
+		np.copyto(hi, bins[:, :, 0])
+		for j in range(1, k):
+			np.minimum(lo, bins[:, :, j], out=lo)
+			np.maximum(hi, bins[:, :, j], out=hi)
+	else:
+		np.min(bins, axis=2, out=lo)
+		np.max(bins, axis=2, out=hi)
+	x[0:2 * n_bins:2] = skip + np.arange(n_bins) * k
+	x[1:2 * n_bins:2] = x[0:2 * n_bins:2] + k / 2
+	if n_out > n_bins:
+		np.min(data[:, end:], axis=1, out=y[:, -2])
+		np.max(data[:, end:], axis=1, out=y[:, -1])
+		x[-2] = end
+		x[-1] = n_samples - 1
+	return x, y
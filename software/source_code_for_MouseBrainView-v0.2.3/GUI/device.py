@@ -0,0 +1,72 @@
+#-------------------------------------------------------------------------------
+# author:	Nikita Makarevich
+# email:	nikita.makarevich@spbpu.com
+# 2021
+#-------------------------------------------------------------------------------
+# Mouse Brain View
+#-------------------------------------------------------------------------------
+# Base station state, as reported by the command port replies.
+#-------------------------------------------------------------------------------
+
+# Used until the device reports its own values
+DEFAULT_CH_COUNT   = 32
+DEFAULT_SAMPLERATE = 1000 # Hz
+
+# Integer parameters, low_bw in mHz, high_bw and samplerate in Hz
+PARAMS = ['samplerate', 'ch_count', 'low_bw', 'high_bw', 'dsp_en', 'dsp_code']
+
+# Replies look like:
+#   >HW Ver 1.0.0 FW Ver 1.0.0 build date 28.12.2020;
+#   >samplerate:1000Hz;
+#   >ch_count:32;
+#   >status:samplerate:1000;low_bw:500000;high_bw:20000;dsp_en:0;dsp_code:0;
+#   >samplerate:ok;
+# errors have no '>': "parameter not found;", "not today;"
+class DeviceState:
+	def __init__(self):
+		self.clear()
+
+	def clear(self):
+		self.version = ''
+		for name in PARAMS:
+			setattr(self, name, None)
+
+	# Returns True if the state has changed
+	def parse(self, reply):
+		reply = reply.strip()
+		if not reply.startswith('>'):
+			return False
+		body = reply[1:].rstrip(';')
+		if body.startswith('status:'):
+			fields = body[len('status:'):].split(';')
+		elif ':' in body:
+			fields = [body]
+		else:
+			if self.version == body:
+				return False
+			self.version = body
+			return True
+
+		changed = False
+		for field in fields:
+			name, _, value = field.partition(':')
+			if name not in PARAMS or value == 'ok':
+				continue
+			if value.endswith('Hz'):
+				value = value[:-2]
+			try:
+				changed |= self.set(name, int(value))
+			except ValueError:
+				pass
+		return changed
+
+	def set(self, name, value):
+		if getattr(self, name) == value:
+			return False
+		setattr(self, name, value)
+		return True
+
+	def as_dict(self):
+		info = {name : getattr(self, name) for name in PARAMS}
+		info['version'] = self.version
+		return info
@@ -0,0 +1,141 @@
+#-------------------------------------------------------------------------------
+# author:	Nikita Makarevich
+# email:	nikita.makarevich@spbpu.com
+# 2021
+#-------------------------------------------------------------------------------
+# Mouse Brain View
+#-------------------------------------------------------------------------------
+# Streaming IIR filters on the host.
+# Filters are cascades of second order sections (biquads), coefficients are
+# taken from the Audio EQ Cookbook (R. Bristow-Johnson), Butterworth
+# high-pass and low-pass and a notch for the power line.
+#
+# A section is run as a state-space system, so a whole block of samples is
+# filtered with matrix products for all channels at once instead of a loop
+# over samples. For a block of L samples X (L, n_channels) and state S
+# (2, n_channels):
+#   Y  = T X + O S        T - (L, L) Toeplitz matrix of the impulse response
+#   S' = A^L S + R X      O - (L, 2), R - (2, L)
+# The matrices are computed once for the longest block.
+#-------------------------------------------------------------------------------
+
+import numpy as np
+
+#---------------------------------------------------------------------------#
+# Design, every function returns rows [b0, b1, b2, a1, a2] with a0 = 1
+#---------------------------------------------------------------------------#
+def _biquad(b, a):
+	b = np.asarray(b, dtype=float) / a[0]
+	return [b[0], b[1], b[2], a[1] / a[0], a[2] / a[0]]
+
+# Q of the sections of a Butterworth filter of even order
+def butterworth_q(order):
+	return [1 / (2 * np.cos(np.pi * (2 * k + 1) / (2 * order))) for k in range(order // 2)]
+
+def lowpass(f0, samplerate, order=4):
+	sections = []
+	for q in butterworth_q(order):
+		w0 = 2 * np.pi * f0 / samplerate
+		c, alpha = np.cos(w0), np.sin(w0) / (2 * q)
+		sections.append(_biquad([(1 - c) / 2, 1 - c, (1 - c) / 2], [1 + alpha, -2 * c, 1 - alpha]))
+	return sections
+
+def highpass(f0, samplerate, order=4):
+	sections = []
+	for q in butterworth_q(order):
+		w0 = 2 * np.pi * f0 / samplerate
+		c, alpha = np.cos(w0), np.sin(w0) / (2 * q)
+		sections.append(_biquad([(1 + c) / 2, -(1 + c), (1 + c) / 2], [1 + alpha, -2 * c, 1 - alpha]))
+	return sections
+
+# q = f0 / stop band width
+def notch(f0, samplerate, q=30):
+	w0 = 2 * np.pi * f0 / samplerate
+	c, alpha = np.cos(w0), np.sin(w0) / (2 * q)
+	return [_biquad([1, -2 * c, 1], [1 + alpha, -2 * c, 1 - alpha])]
+
+# Cutoffs in Hz, None or 0 - off. Notch removes line_freq and its
+# harmonics below Nyquist, up to n_harmonics frequencies.
+def design(samplerate, high_pass=None, low_pass=None, line_freq=None, n_harmonics=1):
+	nyquist = samplerate / 2
+	sections = []
+	if high_pass and high_pass < nyquist:
+		sections += highpass(high_pass, samplerate)
+	if low_pass and low_pass < nyquist:
+		sections += lowpass(low_pass, samplerate)
+	if line_freq:
+		for h in range(1, n_harmonics + 1):
+			if line_freq * h < nyquist * 0.98:
+				sections += notch(line_freq * h, samplerate)
+	return np.array(sections, dtype=float).reshape(-1, 5)
+
+#---------------------------------------------------------------------------#
+# Streaming filter
+#---------------------------------------------------------------------------#
+class Section:
+	def __init__(self, coefs, max_block):
+		b0, b1, b2, a1, a2 = coefs
+		N = max_block
+		A = np.array([[-a1, 1.0], [-a2, 0.0]])
+		B = np.array([b1 - a1 * b0, b2 - a2 * b0])
+		self.b0, self.b1, self.b2, self.a1, self.a2 = b0, b1, b2, a1, a2
+		# P[m] = A^m
+		P = np.empty((N + 1, 2, 2))
+		P[0] = np.eye(2)
+		for m in range(1, N + 1):
+			P[m] = A @ P[m - 1]
+		self.P = P
+		# impulse response h[0] = b0, h[m] = C A^(m-1) B, C = [1, 0]
+		h = np.empty(N)
+		h[0] = b0
+		h[1:] = P[:N - 1, 0, :] @ B
+		idx = np.arange(N)
+		lag = idx[:, None] - idx[None, :]
+		self.T = np.where(lag >= 0, h[np.maximum(lag, 0)], 0.0)
+		self.O = P[:N, 0, :].copy()                # row n is C A^n
+		self.R = (P[N - 1::-1] @ B).T.copy()       # column k is A^(N-1-k) B
+		self.N = N
+
+	# State for a constant input x, so the output starts without a step
+	def steady_state(self, x):
+		y = x * (self.b0 + self.b1 + self.b2) / (1 + self.a1 + self.a2)
+		return np.array([y - self.b0 * x, self.b2 * x - self.a2 * y]), y
+
+	# x - (L, n_channels), L <= N, state is updated in place
+	def run(self, x, state):
+		L = len(x)
+		y = self.T[:L, :L] @ x + self.O[:L] @ state
+		state[:] = self.P[L] @ state + self.R[:, self.N - L:] @ x
+		return y
+
+class FilterBank:
+	# sos - rows [b0, b1, b2, a1, a2], see design()
+	def __init__(self, sos, n_channels, max_block=256):
+		self.n_channels = n_channels
+		self.max_block = max_block
+		self.sections = [Section(c, max_block) for c in sos]
+		self.state = None # (n_sections, 2, n_channels), set by the first block
+
+	def reset(self):
+		self.state = None
+
+	# Start as if the first frame had been there forever
+	def _init_state(self, x0):
+		self.state = np.empty((len(self.sections), 2, self.n_channels))
+		x = x0.astype(float)
+		for i, s in enumerate(self.sections):
+			self.state[i], x = s.steady_state(x)
+
+	# block - (n_rows, n_channels), returns filtered float32 array of the same shape
+	def process(self, block):
+		if not self.sections:
+			return block.astype(np.float32)
+		if self.state is None:
+			self._init_state(block[0])
+		out = np.empty(block.shape, dtype=np.float32)
+		for i in range(0, len(block), self.max_block):
+			x = block[i:i + self.max_block].astype(float)
+			for s, state in zip(self.sections, self.state):
+				x = s.run(x, state)
+			out[i:i + self.max_block] = x
+		return out
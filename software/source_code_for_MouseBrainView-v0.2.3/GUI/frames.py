@@ -0,0 +1,62 @@
+#-------------------------------------------------------------------------------
+# author:	Nikita Makarevich
+# email:	nikita.makarevich@spbpu.com
+# 2021
+#-------------------------------------------------------------------------------
+# Mouse Brain View
+#-------------------------------------------------------------------------------
+# Splits the data stream into frames.
+# One frame is one sample of every channel, channels are interleaved.
+#-------------------------------------------------------------------------------
+
+import numpy as np
+
+class FrameAssembler:
+	def __init__(self, n_channels=32, dtype=np.uint16, capacity=65536):
+		self.n_channels = n_channels
+		self.dtype = np.dtype(dtype)
+		self.frame_size = n_channels * self.dtype.itemsize
+		self.buffer = bytearray(capacity + self.frame_size)
+		self.start = 0  # position of not completed frame in the buffer
+		self.n_left = 0 # bytes of not completed frame
+		self.frames = 0 # total number of frames returned
+
+	# Returns complete frames as array of shape (n_rows, n_channels).
+	# The array is a view into the chunk or into the internal buffer,
+	# it is valid until the next call and until the chunk is reused.
+	def feed(self, chunk):
+		chunk = memoryview(chunk).cast('B')
+		size = len(chunk)
+		if self.n_left == 0:
+			# Aligned stream, frames are taken from the chunk directly
+			n_rows = size // self.frame_size
+			end = n_rows * self.frame_size
+			self.start = 0
+			self.n_left = size - end
+			self.buffer[:self.n_left] = chunk[end:]
+			return self._frames(chunk[:end], n_rows)
+
+		if self.start + self.n_left + size > len(self.buffer):
+			# Move not completed frame to the buffer start, it is shorter than one frame
+			self.buffer[:self.n_left] = self.buffer[self.start:self.start + self.n_left]
+			self.start = 0
+			if self.n_left + size > len(self.buffer):
+				self.buffer = self.buffer[:self.n_left] + bytearray(size + self.frame_size)
+		pos = self.start + self.n_left
+		self.buffer[pos:pos + size] = chunk
+		total = self.n_left + size
+		n_rows = total // self.frame_size
+		end = n_rows * self.frame_size
+		frames = self._frames(memoryview(self.buffer)[self.start:self.start + end], n_rows)
+		self.start += end
+		self.n_left = total - end
+		return frames
+
+	def _frames(self, data, n_rows):
+		self.frames += n_rows
+		return np.frombuffer(data, dtype=self.dtype).reshape(n_rows, self.n_channels)
+
+	def reset(self):
+		self.start = 0
+		self.n_left = 0
+		self.frames = 0
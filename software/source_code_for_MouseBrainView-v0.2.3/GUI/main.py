@@ -19,6 +19,7 @@ import json
 import socket
 import errno
 import time
+from datetime import datetime
 # GUI
 from PyQt5.QtCore import (
 
@@ -34,8 +35,8 @@ from PyQt5.QtCore import (
 from PyQt5.QtWidgets import (
 	QApplication,
 	QMainWindow,
-	QGridLayout,
 	QFileDialog,
+	QLabel,
 )
 from PyQt5.QtGui import (
 	QIcon,
@@ -43,28 +44,36 @@ from PyQt5.QtGui import (
 	QTextCursor,
 )
 import pyqtgraph as pg
-from queue import Queue
 # local imports
 from build.MainForm import Ui_MainWindow
 import build.res
 
-from client import MyClient
+from client import (
+	MyClient,
+	INFO_COMMANDS,
+	STREAM_ON_COMMANDS,
+	STREAM_OFF_COMMANDS,
+	RECONNECT_MIN,
+	RECONNECT_MAX,
+	RECONNECT_TIMEOUTS,
+	settings_params,
+)
 from CSVWorker import CSVWorker
+from RawWorker import RawWorker
+from ringbuffer import RingBuffer
+from frames import FrameAssembler
+from plotview import GridPlotView, StackedPlotView, HeatmapView, SpikeRasterView, SpectrumView, ChannelQualityView
+from spectrum import welch_psd, pow2_floor, SpectrumHistory
+from spikes import SpikeDetector, SpikeBuffer
+from quality import ChannelStats
+from montage import common_average, median_reference, bipolar, load_matrix, montage_meta
+from device import DeviceState, DEFAULT_CH_COUNT, DEFAULT_SAMPLERATE
+from timestamps import SampleClock
+from stats import FlowStats
+from tracing import tracer
+from filters import FilterBank, design
 
 
-# Shift values in np.array
-def npshift(arr, num, cval=np.nan):
-	result = np.empty_like(arr)
-	if num > 0:
-		result[:num] = cval
-		result[num:] = arr[:-num]
-	elif num < 0:
-		result[num:] = cval
-		result[:num] = arr[-num:]
-	else:
-		result = arr
-	return result
-
 class Main_window(QMainWindow):
 	def __init__(self, parent, registry):
 		#---------------------------------------------------------------------------#
@@ -86,6 +95,8 @@ class Main_window(QMainWindow):
 		self.ui.pb_connect.clicked.connect(self.on_pb_connect_click)
 		self.ui.pb_data_flow.clicked.connect(self.on_pb_data_flow_click)
 		self.ui.pb_csv_dir.clicked.connect(self.on_pb_csv_dir_click)
+		self.ui.pb_save_trace.clicked.connect(self.on_pb_save_trace_click)
+		self.ui.cb_trace.toggled.connect(tracer.enable)
 		#---------------------------------------------------------------------------#
 		self.pixmap_ok	  = QPixmap(':/icons/ok.png')
 		self.pixmap_error = QPixmap(':/icons/error.png')
@@ -95,7 +106,33 @@ class Main_window(QMainWindow):
 			'line_ip'       : '192.168.2.213',
 			'line_port_com' : '1020',
 			'line_port_dat' : '1000',
-			'line_csv_dir'  : (Path(__file__).parent / "csv")
+			'cb_auto_reconnect' : False,
+			'line_csv_dir'  : (Path(__file__).parent / "csv"),
+			'spin_fps'      : 30,
+			'spin_window'   : 1.0,
+			'combo_view'    : 0,
+			'cb_trace'      : False,
+			'spin_filter_hp': 0.0,
+			'spin_filter_lp': 0.0,
+			'combo_notch'   : 0,
+			'cb_spectrum'   : False,
+			'combo_spectrum': 0,
+			'spin_spectrum_ch' : 1,
+			'spin_spectrum_fps': 4,
+			'cb_spikes'     : False,
+			'combo_spike_sign'     : 0,
+			'spin_spike_threshold' : 5.0,
+			'spin_spike_refractory': 2.0,
+			'combo_montage'     : 0,
+			'line_montage_file' : '',
+			'cb_montage_display': True,
+			'cb_montage_record' : False,
+			'combo_rec_format': 0,
+			'combo_samplerate': '1000',
+			'combo_lowpass'   : '500',
+			'combo_highpass'  : '20000',
+			'cb_dsp_enable'   : False,
+			'combo_dsp_cutoff': '0: DIFF',
 		}
 		# Load settings from local json file
 		if os.path.exists(Path(__file__).parent / 'autoconf.json'):
@@ -110,34 +147,143 @@ class Main_window(QMainWindow):
 		self.ui.line_ip.setText      (self.autoconf.get('line_ip' , self.autoconf_template['line_ip']))
 		self.ui.line_port_com.setText(self.autoconf.get('line_port_com' , self.autoconf_template['line_port_com']))
 		self.ui.line_port_dat.setText(self.autoconf.get('line_port_dat' , self.autoconf_template['line_port_dat']))
+		self.ui.cb_auto_reconnect.setChecked(bool(self.autoconf.get('cb_auto_reconnect', self.autoconf_template['cb_auto_reconnect'])))
 		self.ui.line_csv_dir.setText (self.autoconf.get('line_csv_dir', str(self.autoconf_template['line_csv_dir'].resolve())))
+		self.ui.combo_rec_format.setCurrentIndex(int(self.autoconf.get('combo_rec_format', self.autoconf_template['combo_rec_format'])))
+		self.ui.combo_samplerate.setCurrentText(str(self.autoconf.get('combo_samplerate', self.autoconf_template['combo_samplerate'])))
+		self.ui.combo_lowpass.setCurrentText   (str(self.autoconf.get('combo_lowpass', self.autoconf_template['combo_lowpass'])))
+		self.ui.combo_highpass.setCurrentText  (str(self.autoconf.get('combo_highpass', self.autoconf_template['combo_highpass'])))
+		self.ui.cb_dsp_enable.setChecked       (bool(self.autoconf.get('cb_dsp_enable', self.autoconf_template['cb_dsp_enable'])))
+		self.ui.combo_dsp_cutoff.setCurrentText(str(self.autoconf.get('combo_dsp_cutoff', self.autoconf_template['combo_dsp_cutoff'])))
+		self.ui.spin_fps.setValue    (int(self.autoconf.get('spin_fps', self.autoconf_template['spin_fps'])))
+		self.ui.spin_window.setValue (float(self.autoconf.get('spin_window', self.autoconf_template['spin_window'])))
+		# 'cb_single_plot' is from the versions before the heatmap
+		view = self.autoconf.get('combo_view', 1 if self.autoconf.get('cb_single_plot') else self.autoconf_template['combo_view'])
+		self.ui.combo_view.setCurrentIndex(int(view))
+		self.ui.cb_trace.setChecked  (bool(self.autoconf.get('cb_trace', self.autoconf_template['cb_trace'])))
+		tracer.enable(self.ui.cb_trace.isChecked())
+		self.ui.spin_filter_hp.setValue(float(self.autoconf.get('spin_filter_hp', self.autoconf_template['spin_filter_hp'])))
+		self.ui.spin_filter_lp.setValue(float(self.autoconf.get('spin_filter_lp', self.autoconf_template['spin_filter_lp'])))
+		self.ui.combo_notch.setCurrentIndex(int(self.autoconf.get('combo_notch', self.autoconf_template['combo_notch'])))
+		self.ui.cb_spectrum.setChecked(bool(self.autoconf.get('cb_spectrum', self.autoconf_template['cb_spectrum'])))
+		self.ui.combo_spectrum.setCurrentIndex(int(self.autoconf.get('combo_spectrum', self.autoconf_template['combo_spectrum'])))
+		self.ui.spin_spectrum_ch.setValue(int(self.autoconf.get('spin_spectrum_ch', self.autoconf_template['spin_spectrum_ch'])))
+		self.ui.spin_spectrum_fps.setValue(int(self.autoconf.get('spin_spectrum_fps', self.autoconf_template['spin_spectrum_fps'])))
+		self.ui.cb_spikes.setChecked(bool(self.autoconf.get('cb_spikes', self.autoconf_template['cb_spikes'])))
+		self.ui.combo_spike_sign.setCurrentIndex(int(self.autoconf.get('combo_spike_sign', self.autoconf_template['combo_spike_sign'])))
+		self.ui.spin_spike_threshold.setValue(float(self.autoconf.get('spin_spike_threshold', self.autoconf_template['spin_spike_threshold'])))
+		self.ui.spin_spike_refractory.setValue(float(self.autoconf.get('spin_spike_refractory', self.autoconf_template['spin_spike_refractory'])))
+		self.ui.combo_montage.setCurrentIndex(int(self.autoconf.get('combo_montage', self.autoconf_template['combo_montage'])))
+		self.ui.line_montage_file.setText(self.autoconf.get('line_montage_file', self.autoconf_template['line_montage_file']))
+		self.ui.cb_montage_display.setChecked(bool(self.autoconf.get('cb_montage_display', self.autoconf_template['cb_montage_display'])))
+		self.ui.cb_montage_record.setChecked(bool(self.autoconf.get('cb_montage_record', self.autoconf_template['cb_montage_record'])))
 		#---------------------------------------------------------------------------#
 		self.client = MyClient(self)
 		self.client.state_changed.connect(self.on_net_state_changed)
 		self.client.command_signal.connect(self.on_net_command)
 		self.client.data_signal.connect(self.on_net_data)
 		self.client.connection_error_signal.connect(self.on_net_error)
+		self.client.device_changed.connect(self.on_device_changed)
 		#---------------------------------------------------------------------------#
-		self.olddat = b''
+		# Sized for DEFAULT_CH_COUNT until the device reports its channel count
+		self.device_info = DeviceState().as_dict()
+		self.applied_layout = (DEFAULT_CH_COUNT, DEFAULT_SAMPLERATE) # (ch_count, samplerate) of the buffers
+		self.assembler = FrameAssembler(DEFAULT_CH_COUNT)
+		# Re-referencing, the display and the recording apply it or not
+		# independently, the recording keeps its montage from Start
+		self.montage = None
+		self.rec_montage = None
+		self.montage_init()
 		pg.setConfigOption('background', 'w')
 		pg.setConfigOption('foreground', 'k')
-		self.plots_init(32)
+		# Spectrum is computed from the plot data by its own timer, see on_spectrum_timer
+		self.spectrumview = SpectrumView()
+		self.spectrum_history = None
+		self.spectrum_freqs = None
+		self.spectrum_count = 0 # curvebuffers.count at the last update
+		# Spikes of the display data, indices are curvebuffers.count based
+		self.spikes = SpikeBuffer()
+		self.spike_detector = None
+		self.plots_init(self.display_channels(), self.window_samples())
+		# Display filter, can be changed while the data flows
+		self.display_filter = None
+		self.filter_init()
+		self.ui.spin_filter_hp.valueChanged.connect(self.on_filter_changed)
+		self.ui.spin_filter_lp.valueChanged.connect(self.on_filter_changed)
+		self.ui.combo_notch.currentIndexChanged.connect(self.on_filter_changed)
+		self.spikes_init()
+		self.ui.cb_spikes.toggled.connect(self.spikes_init)
+		self.ui.combo_spike_sign.currentIndexChanged.connect(self.spikes_init)
+		self.ui.spin_spike_threshold.valueChanged.connect(self.spikes_init)
+		self.ui.spin_spike_refractory.valueChanged.connect(self.spikes_init)
+		self.ui.combo_montage.currentIndexChanged.connect(self.on_montage_changed)
+		self.ui.line_montage_file.editingFinished.connect(self.on_montage_changed)
+		self.ui.cb_montage_display.toggled.connect(self.on_montage_changed)
+		self.ui.pb_montage_file.clicked.connect(self.on_pb_montage_file_click)
+		# Channel quality of the received data, shown by the status timer
+		self.quality = None
+		self.qualityview = None
+		self.quality_init()
+		self.ui.spin_window.valueChanged.connect(self.on_window_changed)
+		self.ui.combo_view.currentIndexChanged.connect(self.on_view_changed)
 		self.ui.splitter.setStretchFactor(1, 1)
 		self.ui.splitter.setSizes([500,100])
+		# Curves are repainted by timer, not on every received chunk
+		self.plot_dirty = False
+		self.plot_skip = 0
+		self.plot_timer = QTimer()
+		self.plot_timer.timeout.connect(self.on_plot_timer)
+		self.ui.spin_fps.valueChanged.connect(self.on_fps_changed)
+		self.on_fps_changed(self.ui.spin_fps.value())
+		self.plot_timer.start()
+		self.spectrum_timer = QTimer()
+		self.spectrum_timer.timeout.connect(self.on_spectrum_timer)
+		self.ui.spin_spectrum_fps.valueChanged.connect(self.on_spectrum_fps_changed)
+		self.on_spectrum_fps_changed(self.ui.spin_spectrum_fps.value())
+		self.ui.cb_spectrum.toggled.connect(self.on_spectrum_toggled)
+		self.ui.combo_spectrum.currentIndexChanged.connect(self.on_spectrum_mode_changed)
+		self.ui.spin_spectrum_ch.valueChanged.connect(self.on_spectrum_mode_changed)
+		self.on_spectrum_toggled(self.ui.cb_spectrum.isChecked())
 		#---------------------------------------------------------------------------#
 		self.write_csv_flag = False
-		self.csvqq = Queue()
-		self.csvww = CSVWorker(self.csvqq, Path(self.ui.line_csv_dir.text()))
+		self.write_raw_flag = False
+		self.recww = None
+		self.flow_pending = False
+		self.flow_params = []
+		#---------------------------------------------------------------------------#
+		# Automatic reconnect, the flow and the recording go on after it
+		self.reconnecting = False
+		self.reconnect_delay = RECONNECT_MIN
+		self.reconnect_timer = QTimer()
+		self.reconnect_timer.setSingleShot(True)
+		self.reconnect_timer.timeout.connect(self.on_reconnect_timer)
+		self.n_timeouts = 0
+		self.t_last_data = None # monotonic time of the last data chunk
+		self.gap_start = None   # (monotonic, wall clock) time when the data stopped
+		# Sample rate of the device measured with the host clock
+		self.clock = None
 		#---------------------------------------------------------------------------#
+		# Flow counters in the status bar, see flow_stats()
+		self.stats = FlowStats()
+		self.status_label = QLabel()
+		self.ui.statusbar.addWidget(self.status_label, 1)
+		self.rec_dropped = 0
+		self.status_timer = QTimer()
+		self.status_timer.timeout.connect(self.on_status_timer)
+		self.status_timer.start(1000)
 		#---------------------------------------------------------------------------#
 		#--------------------------------[__INIT__ END]-----------------------------#
 		#---------------------------------------------------------------------------#
 	
 	# Closing main window
 	def closeEvent(self, event):
-		if self.client.state >= MyClient.STATE_COM_CONNECTED:
+		if self.reconnecting:
+			self.reconnecting = False
+			self.reconnect_timer.stop()
 			self.flow_stop()
-			self.client.disconnect_from_host()
+		elif self.client.state >= MyClient.STATE_COM_CONNECTED:
+			self.flow_stop()
+		self.client.close()
 		
 		# Save window geometry into registry to restore it later
 		self.reg_save("Geometry", "MainWindow", self.saveGeometry())
@@ -146,7 +292,34 @@ class Main_window(QMainWindow):
 		self.autoconf['line_ip']        = self.ui.line_ip.text()
 		self.autoconf['line_port_com']  = self.ui.line_port_com.text()
 		self.autoconf['line_port_dat']  = self.ui.line_port_dat.text()
+		self.autoconf['cb_auto_reconnect'] = self.ui.cb_auto_reconnect.isChecked()
 		self.autoconf['line_csv_dir']   = self.ui.line_csv_dir.text()
+		self.autoconf['combo_rec_format'] = self.ui.combo_rec_format.currentIndex()
+		self.autoconf['combo_samplerate'] = self.ui.combo_samplerate.currentText()
+		self.autoconf['combo_lowpass']    = self.ui.combo_lowpass.currentText()
+		self.autoconf['combo_highpass']   = self.ui.combo_highpass.currentText()
+		self.autoconf['cb_dsp_enable']    = self.ui.cb_dsp_enable.isChecked()
+		self.autoconf['combo_dsp_cutoff'] = self.ui.combo_dsp_cutoff.currentText()
+		self.autoconf['spin_fps']       = self.ui.spin_fps.value()
+		self.autoconf['spin_window']    = self.ui.spin_window.value()
+		self.autoconf['combo_view']     = self.ui.combo_view.currentIndex()
+		self.autoconf.pop('cb_single_plot', None)
+		self.autoconf['cb_trace']       = self.ui.cb_trace.isChecked()
+		self.autoconf['spin_filter_hp'] = self.ui.spin_filter_hp.value()
+		self.autoconf['spin_filter_lp'] = self.ui.spin_filter_lp.value()
+		self.autoconf['combo_notch']    = self.ui.combo_notch.currentIndex()
+		self.autoconf['cb_spectrum']    = self.ui.cb_spectrum.isChecked()
+		self.autoconf['combo_spectrum'] = self.ui.combo_spectrum.currentIndex()
+		self.autoconf['spin_spectrum_ch']  = self.ui.spin_spectrum_ch.value()
+		self.autoconf['spin_spectrum_fps'] = self.ui.spin_spectrum_fps.value()
+		self.autoconf['cb_spikes']      = self.ui.cb_spikes.isChecked()
+		self.autoconf['combo_spike_sign']      = self.ui.combo_spike_sign.currentIndex()
+		self.autoconf['spin_spike_threshold']  = self.ui.spin_spike_threshold.value()
+		self.autoconf['spin_spike_refractory'] = self.ui.spin_spike_refractory.value()
+		self.autoconf['combo_montage']     = self.ui.combo_montage.currentIndex()
+		self.autoconf['line_montage_file'] = self.ui.line_montage_file.text()
+		self.autoconf['cb_montage_display'] = self.ui.cb_montage_display.isChecked()
+		self.autoconf['cb_montage_record']  = self.ui.cb_montage_record.isChecked()
 		with open(Path(__file__).parent / 'autoconf.json', 'w') as json_file:
 			try:
 				json.dump(self.autoconf, json_file)
@@ -157,10 +330,17 @@ class Main_window(QMainWindow):
 	@pyqtSlot(int)
 	def on_net_state_changed(self, state):
 		if state == MyClient.STATE_DISCONNECTED:
+			if self.reconnecting:
+				self.set_pixmap(self.ui.label_icon_connect, self.pixmap_wait)
+				self.schedule_reconnect()
+				return
 			self.ui.pb_connect.setText('Connect')
 			self.clear_pixmap(self.ui.label_icon_connect)
 			self.ui.pb_data_flow.setText('Start')
 			self.message('Disconnected<br>')
+			if self.flow_pending:
+				# data port connection failed
+				self.flow_stop()
 			
 		elif state == MyClient.STATE_COM_CONNECTING:
 			self.message('Connecting to command port<br>')
@@ -177,45 +357,361 @@ class Main_window(QMainWindow):
 		elif state == MyClient.STATE_DAT_CONNECTED:
 			self.ui.pb_connect.setText('Disconnect')
 			self.set_pixmap(self.ui.label_icon_connect, self.pixmap_ok)
+			if self.flow_pending:
+				self.flow_pending = False
+				if self.reconnecting:
+					self.reconnecting = False
+					self.message('Reconnected<br>')
+					self.clock.new_segment()
+				else:
+					self.clock = SampleClock(dict(self.flow_params)['samplerate'])
+					self.stats.reset()
+					self.rec_dropped = 0
+				self.assembler.reset()
+				# no steps from old samples or over the gap
+				if self.display_filter is not None:
+					self.display_filter.reset()
+				if self.spike_detector is not None:
+					self.spike_detector.reset()
+				self.quality.reset()
+				self.client.flow_start()
 	
 	@pyqtSlot(str)
 	def on_net_command(self, msg):
 		self.message("%s<br>" % msg)
 	
+	@pyqtSlot(dict)
+	def on_device_changed(self, info):
+		self.device_info = info
+		# buffers can not be changed while the data flows, and nothing is
+		# rebuilt if the channel count and sample rate are the same
+		if self.client.state < MyClient.STATE_FLOW and self.device_layout() != self.applied_layout:
+			self.layout_from_device()
+	
+	# Channel count and sample rate reported by the device, the unknown
+	# ones (e.g. cleared on connect) are kept from the last layout
+	def device_layout(self):
+		info = self.device_info
+		return (info['ch_count'] or self.applied_layout[0], info['samplerate'] or self.applied_layout[1])
+	
+	# Size the frame assembler and plots from the channel count and sample rate
+	def layout_from_device(self):
+		self.applied_layout = self.device_layout()
+		n_channels = self.applied_layout[0]
+		if n_channels != self.assembler.n_channels:
+			self.message('Device has %d channels<br>' % n_channels)
+			self.assembler = FrameAssembler(n_channels)
+			self.montage_init()
+		if self.display_channels() != self.curvebuffers.n_channels:
+			self.plots_init(self.display_channels(), self.window_samples())
+		else:
+			self.on_window_changed()
+		self.filter_init()
+		self.spikes_init()
+		self.quality_init()
+	
+	# Montage from the settings, None if there is no re-referencing
+	def montage_init(self):
+		n_channels = self.assembler.n_channels
+		index = self.ui.combo_montage.currentIndex()
+		self.montage = None
+		try:
+			if index == 1:
+				self.montage = common_average(n_channels)
+			elif index == 2:
+				self.montage = median_reference(n_channels)
+			elif index == 3:
+				self.montage = bipolar(n_channels)
+			elif index == 4 and self.ui.line_montage_file.text():
+				self.montage = load_matrix(self.ui.line_montage_file.text(), n_channels)
+		except (OSError, ValueError) as e:
+			self.message('<font style=\"color:#CC0000\";>Montage: %s</font><br>' % e)
+	
+	def display_montage(self):
+		if self.ui.cb_montage_display.isChecked():
+			return self.montage
+		return None
+	
+	# Number and names of the displayed channels, outputs of the montage
+	def display_channels(self):
+		montage = self.display_montage()
+		return montage.n_out if montage is not None else self.assembler.n_channels
+	
+	def display_names(self):
+		montage = self.display_montage()
+		return montage.names if montage is not None else None
+	
+	# Display starts over with the new channels, the recording is not changed
+	@pyqtSlot()
+	def on_montage_changed(self):
+		self.montage_init()
+		self.plots_init(self.display_channels(), self.window_samples())
+		self.filter_init()
+		self.spikes_init()
+		self.plot_dirty = True
+	
+	def on_pb_montage_file_click(self):
+		filename, _ = QFileDialog.getOpenFileName(self, "Montage matrix", '', "CSV (*.csv *.txt);;All Files(*)")
+		if filename:
+			self.ui.line_montage_file.setText(filename)
+			if self.ui.combo_montage.currentIndex() == 4:
+				self.on_montage_changed()
+			else:
+				self.ui.combo_montage.setCurrentIndex(4)
+	
+	def quality_init(self):
+		n_channels = self.assembler.n_channels
+		self.quality = ChannelStats(n_channels, self.plot_samplerate())
+		if self.qualityview is None or len(self.qualityview.badges) != n_channels:
+			if self.qualityview is not None:
+				self.ui.quality_layout.removeWidget(self.qualityview)
+				self.qualityview.setParent(None)
+			self.qualityview = ChannelQualityView(n_channels)
+			self.ui.quality_layout.addWidget(self.qualityview)
+	
+	# Filter bank from the display filter settings, None if all are off
+	def filter_init(self):
+		line_freq = [None, 50, 60][self.ui.combo_notch.currentIndex()]
+		sos = design(self.plot_samplerate(), self.ui.spin_filter_hp.value(), self.ui.spin_filter_lp.value(), line_freq)
+		if len(sos):
+			self.display_filter = FilterBank(sos, self.curvebuffers.n_channels)
+		else:
+			self.display_filter = None
+	
+	# Old samples are filtered differently, the plots start over
+	@pyqtSlot()
+	def on_filter_changed(self):
+		self.filter_init()
+		self.spikes_init()
+		self.curvebuffers.clear()
+		self.plot_dirty = True
+	
+	# Spike detector from the settings, None if the detection is off.
+	# The noise estimate starts over, so do the spikes.
+	@pyqtSlot()
+	def spikes_init(self):
+		self.spikes.clear()
+		if not self.ui.cb_spikes.isChecked():
+			self.spike_detector = None
+			return
+		self.spike_detector = SpikeDetector(
+			self.curvebuffers.n_channels,
+			self.plot_samplerate(),
+			threshold = self.ui.spin_spike_threshold.value(),
+			refractory = self.ui.spin_spike_refractory.value() / 1000,
+			sign = [-1, 1, 0][self.ui.combo_spike_sign.currentIndex()])
+		self.plot_dirty = True
+	
+	def plot_samplerate(self):
+		return self.applied_layout[1]
+	
+	# Display window in samples, views decimate it to their width
+	def window_samples(self):
+		return max(2, int(round(self.ui.spin_window.value() * self.plot_samplerate())))
+	
+	# Resize the ring buffer, the latest samples are kept
+	@pyqtSlot()
+	def on_window_changed(self):
+		n_samples = self.window_samples()
+		old = self.curvebuffers
+		if n_samples == old.n_samples:
+			return
+		self.curvebuffers = RingBuffer(old.n_channels, n_samples, np.float32)
+		n_keep = min(old.count, old.n_samples, n_samples)
+		if n_keep > 0:
+			self.curvebuffers.write(old.view()[:, -n_keep:].T)
+		self.curvebuffers.count = old.count
+		self.plot_dirty = True
+	
 	busy = False
-	@pyqtSlot(bytes)
-	def on_net_data(self, dat):
+	@pyqtSlot(object, float)
+	def on_net_data(self, dat, t):
 		if self.busy:
+			self.stats.dropped_chunks += 1
 			self.message('ERROR - trying to re-enter busy function<br>')
 			return
 		else: self.busy = True
+		self.stats.bytes += len(dat)
+		self.stats.chunks += 1
 		
 		#print(np.frombuffer(dat, dtype=np.uint16))
-		n_plots = len(self.curves)
-		self.olddat = self.olddat + dat
-		if len(self.olddat) >= n_plots * 2:
-			# Split full plots representation and not completed part
-			n_left = len(self.olddat) % (n_plots * 2)
-			n_rows = int(np.floor(len(self.olddat) / (n_plots * 2)))
-			if n_left == 0:
-				buffer = np.frombuffer(self.olddat, dtype=np.uint16)
-				self.olddat = b''
+		self.t_last_data = t
+		self.n_timeouts = 0
+		# Split full plots representation and not completed part
+		t0 = tracer.begin()
+		block = self.assembler.feed(dat)
+		tracer.end('assemble', t0, len(block))
+		if len(block):
+			self.stats.frames += len(block)
+			self.clock.stamp(self.assembler.frames, t)
+			# on the data as received, the rails are in device units
+			t0 = tracer.begin()
+			self.quality.add(block)
+			tracer.end('quality', t0, len(block))
+			# Re-referenced once, if the display or the recording needs it
+			referenced = None
+			montage = self.display_montage()
+			if montage is not None or self.rec_montage is not None:
+				t0 = tracer.begin()
+				if montage is not None:
+					referenced = montage.apply(block)
+				rec_block = block
+				if self.rec_montage is montage:
+					rec_block = referenced
+				elif self.rec_montage is not None:
+					rec_block = self.rec_montage.apply(block)
+				tracer.end('montage', t0, len(block))
 			else:
-				buffer = np.frombuffer(self.olddat[:-n_left], dtype=np.uint16)
-				self.olddat = self.olddat[-n_left:]
-			# Process for plot
-			for i in range(n_rows):
-				for j in range(n_plots):
-					self.curvebuffers[j] = npshift(self.curvebuffers[j], -1, buffer[i*n_plots + j])
-					# ===================== Warning! time-critical function! ===
-					if i == n_rows-1: self.curves[j].setData(self.curvebuffers[j])
-					# ==========================================================
-				if self.client.state >= MyClient.STATE_FLOW and self.write_csv_flag:
-					self.csvqq.put(buffer[i*n_plots:(i+1)*n_plots])
+				rec_block = block
+			# Process for plot, curves are updated by plot_timer
+			display = block if referenced is None else referenced
+			if self.display_filter is not None:
+				t0 = tracer.begin()
+				display = self.display_filter.process(display)
+				tracer.end('filter', t0, len(block))
+			if self.spike_detector is not None:
+				t0 = tracer.begin()
+				spikes = self.spike_detector.process(display, self.curvebuffers.count)
+				self.spikes.add(spikes)
+				self.stats.spikes += len(spikes)
+				tracer.end('spikes', t0, len(block))
+			t0 = tracer.begin()
+			self.curvebuffers.write(display)
+			tracer.end('ring_write', t0)
+			self.plot_dirty = True
+			if self.client.state >= MyClient.STATE_FLOW and self.write_csv_flag:
+				if self.gap_start is not None:
+					self.add_gap(t)
+				# block is only valid during this call
+				t0 = tracer.begin()
+				self.recww.put(rec_block.copy(), t)
+				tracer.end('record_put', t0)
 					
-		#print("olddat len: %d" % len(self.olddat))
 		self.busy = False
 	
+	@pyqtSlot()
+	def on_plot_timer(self):
+		if not self.plot_dirty:
+			return
+		# Previous repaint was longer than the refresh period, let ingest catch up
+		if self.plot_skip > 0:
+			self.plot_skip -= 1
+			self.stats.render_skipped += 1
+			return
+		ts = tracer.begin()
+		t0 = time.perf_counter()
+		self.plot_dirty = False
+		rb = self.curvebuffers
+		self.plotview.set_data(rb.view(), rb.count - rb.n_samples, self.plot_samplerate())
+		dt = (time.perf_counter() - t0) * 1000
+		tracer.end('set_data', ts)
+		self.plot_skip = int(dt / self.plot_timer.interval())
+		self.stats.render_frames += 1
+	
+	# Welch PSD of the latest plot data, segments of up to a second,
+	# overlapped by half
+	SPECTRUM_SEGMENTS = 8   # at most
+	SPECTRUM_COLUMNS = 240  # spectrogram length
+	
+	@pyqtSlot()
+	def on_spectrum_timer(self):
+		rb = self.curvebuffers
+		n_avail = min(rb.count, rb.n_samples)
+		if rb.count == self.spectrum_count or n_avail < 16:
+			return
+		self.spectrum_count = rb.count
+		ts = tracer.begin()
+		samplerate = self.plot_samplerate()
+		nperseg = pow2_floor(min(samplerate, n_avail))
+		n_use = min(n_avail, nperseg * (self.SPECTRUM_SEGMENTS + 1) // 2)
+		freqs, psd = welch_psd(rb.view()[:, -n_use:], samplerate, nperseg)
+		history = self.spectrum_history
+		if history is None or history.data.shape[1:] != psd.shape:
+			history = self.spectrum_history = SpectrumHistory(self.SPECTRUM_COLUMNS, psd.shape[0], psd.shape[1])
+		history.add(psd)
+		self.spectrum_freqs = freqs
+		self.show_spectrum()
+		tracer.end('spectrum', ts, n_use)
+	
+	def show_spectrum(self):
+		history = self.spectrum_history
+		if history is None:
+			return
+		if self.ui.combo_spectrum.currentIndex() == 0:
+			self.spectrumview.set_psd(self.spectrum_freqs, history.latest(), self.display_names())
+		else:
+			ch = min(self.ui.spin_spectrum_ch.value(), history.data.shape[1]) - 1
+			period = self.spectrum_timer.interval() / 1000
+			self.spectrumview.set_spectrogram(self.spectrum_freqs, history.channel(ch), period, history.count)
+	
+	@pyqtSlot(bool)
+	def on_spectrum_toggled(self, checked):
+		self.spectrumview.setVisible(checked)
+		if checked:
+			self.spectrum_timer.start()
+		else:
+			# not computed while hidden
+			self.spectrum_timer.stop()
+	
+	@pyqtSlot()
+	def on_spectrum_mode_changed(self):
+		self.show_spectrum()
+	
+	@pyqtSlot(int)
+	def on_spectrum_fps_changed(self, fps):
+		self.spectrum_timer.setInterval(int(round(1000 / fps)))
+	
+	# Latest counters and rates, see FlowStats.sample()
+	def flow_stats(self):
+		return self.stats.snapshot()
+	
+	@pyqtSlot()
+	def on_status_timer(self):
+		flowing = self.client.flow_is_active
+		reader = self.client.reader
+		recording = flowing and self.write_csv_flag and self.recww is not None
+		v = self.stats.sample(
+			configured_rate  = dict(self.flow_params)['samplerate'] if flowing else 0,
+			effective_rate   = self.clock.rate() if self.clock is not None else None,
+			partial_bytes    = self.assembler.n_left,
+			reader_queue     = reader.queue.qsize() if reader is not None else 0,
+			recorder_queue   = self.recww.queue_depth() if recording else 0,
+			recorder_dropped = self.recww.dropped_frames if recording else 0,
+		)
+		# Signs of overload, a second of data is needed for the rate
+		overload = []
+		if flowing and v['frames'] > v['configured_rate'] and v['frames_per_s'] < 0.9 * v['configured_rate']:
+			overload.append('low frame rate')
+		if reader is not None and v['reader_queue'] > reader.queue.maxsize // 2:
+			overload.append('receive queue')
+		if recording and (v['recorder_queue'] > self.recww.qq.maxsize // 2 or v['recorder_dropped'] > self.rec_dropped):
+			overload.append('recorder')
+		if v['dropped_chunks_per_s'] > 0:
+			overload.append('dropped chunks')
+		self.rec_dropped = v['recorder_dropped']
+		self.stats.values['overload'] = overload
+		quality = self.quality.values()
+		if flowing and quality is not None:
+			self.qualityview.set_values(quality)
+		
+		self.status_label.setText(
+			'RX %.1f kB/s | frames %.0f/%d per s | partial %d B | queues: rx %d, rec %d | '
+			'rec dropped %d | lost chunks %d | render %.1f fps%s' % (
+			v['bytes_per_s'] / 1000, v['frames_per_s'], v['configured_rate'], v['partial_bytes'],
+			v['reader_queue'], v['recorder_queue'], v['recorder_dropped'], v['dropped_chunks'],
+			v['render_frames_per_s'],
+			' | spikes %.0f/s' % v['spikes_per_s'] if self.spike_detector is not None else ''))
+		if overload:
+			self.status_label.setStyleSheet('color:#CC0000;')
+			self.status_label.setToolTip('Overload: ' + ', '.join(overload))
+		else:
+			self.status_label.setStyleSheet('')
+			self.status_label.setToolTip('')
+	
+	@pyqtSlot(int)
+	def on_fps_changed(self, fps):
+		self.plot_timer.setInterval(int(round(1000 / fps)))
+	
 	@pyqtSlot(socket.error)
 	def on_net_error(self, e):
 		if self.net_error_busy:
@@ -224,12 +720,24 @@ class Main_window(QMainWindow):
 		
 		print(e)
 		self.set_pixmap(self.ui.label_icon_connect, self.pixmap_error)
+		auto = self.ui.cb_auto_reconnect.isChecked()
 		if type(e) is socket.timeout:
 			self.message('<font style=\"color:#CC00CC\";>Timeout</font><br>')
 			#self.clear_pixmap(self.ui.label_icon_connect)
+			# no data for several seconds, the link is most likely gone
+			if auto and self.client.flow_is_active:
+				self.n_timeouts += 1
+				if self.n_timeouts >= RECONNECT_TIMEOUTS:
+					self.n_timeouts = 0
+					self.begin_reconnect()
+			self.net_error_busy = False
+			return
+		if auto and (self.client.flow_is_active or self.reconnecting):
+			self.message("<font style=\"color:#CC0000\";>Connection lost: {}</font><br>".format(os.strerror(e.errno) if e.errno else e))
+			self.begin_reconnect()
 			self.net_error_busy = False
 			return
-		if type(e) is socket.error:
+		if isinstance(e, socket.error):
 			print(os.strerror(e.errno))
 			if e.errno == errno.ECONNRESET:
 				self.flow_stop()
@@ -285,13 +793,79 @@ class Main_window(QMainWindow):
 		ans = self.client.command(cmd)
 		return ans
 	
+	def perform_commands(self, cmds):
+		for cmd in cmds:
+			self.message("<b>%s</b><br>" % cmd)
+		return self.client.commands(cmds)
+	
 	def flow_stop(self):
+		self.flow_pending = False
 		self.client.flow_stop()
-		self.perform_command('`exec-stream_off;')
+		self.perform_commands(STREAM_OFF_COMMANDS)
 		self.ui.pb_data_flow.setText('Start')
-		self.csvww.running = False
+		if self.recww is not None:
+			self.recww.stop()
+		self.rec_montage = None
+		if self.clock is not None:
+			rate, drift = self.clock.rate(), self.clock.drift_ppm()
+			if rate is not None:
+				self.message('Effective sample rate %.3f Hz, clock drift %+.0f ppm<br>' % (rate, drift or 0))
+			self.clock = None
+	
+	# Keep the recorder and reconnect with the same settings
+	def begin_reconnect(self):
+		if not self.reconnecting:
+			self.reconnecting = True
+			self.reconnect_delay = RECONNECT_MIN
+			if self.write_csv_flag and self.t_last_data is not None:
+				self.gap_start = (self.t_last_data, time.time() - (time.monotonic() - self.t_last_data))
+		self.flow_pending = False
+		if self.client.state != MyClient.STATE_DISCONNECTED:
+			# schedule_reconnect() is called when it is disconnected
+			self.client.disconnect_from_host()
+	
+	def schedule_reconnect(self):
+		self.message('Reconnecting in %.1f s<br>' % self.reconnect_delay)
+		self.reconnect_timer.start(int(self.reconnect_delay * 1000))
+		self.reconnect_delay = min(self.reconnect_delay * 2, RECONNECT_MAX)
+	
+	@pyqtSlot()
+	def on_reconnect_timer(self):
+		if not self.reconnecting:
+			return
+		# A failed step disconnects, the next steps fail quietly and
+		# on_net_state_changed schedules the next attempt
+		self.client.connect_to_host_com()
+		self.perform_commands(INFO_COMMANDS)
+		self.client.configure(self.flow_params)
+		self.perform_commands(STREAM_ON_COMMANDS)
+		self.flow_pending = True
+		self.client.connect_to_host_dat()
+	
+	def cancel_reconnect(self):
+		self.message('Reconnect cancelled<br>')
+		self.reconnecting = False
+		self.reconnect_timer.stop()
+		self.gap_start = None
+		self.flow_stop()
+		self.client.disconnect_from_host()
+		if self.client.state == MyClient.STATE_DISCONNECTED:
+			self.on_net_state_changed(MyClient.STATE_DISCONNECTED)
+	
+	# Called with the first block after reconnect
+	def add_gap(self, t):
+		t_mono, t_wall = self.gap_start
+		self.gap_start = None
+		duration = t - t_mono
+		samplerate = dict(self.flow_params)['samplerate']
+		start = datetime.fromtimestamp(t_wall).isoformat()
+		self.recww.add_gap(start, duration, round(duration * samplerate))
+		self.message('Gap in recording: %.3f s<br>' % duration)
 	
 	def on_pb_connect_click(self):
+		if self.reconnecting:
+			self.cancel_reconnect()
+			return
 		if self.client.state >= MyClient.STATE_COM_CONNECTED:
 			# then disconnect
 			self.message('Disconnecting<br>')
@@ -303,56 +877,66 @@ class Main_window(QMainWindow):
 			self.message('Connecting to %s:%i<br>' % (self.ui.line_ip.text(), int(self.ui.line_port_com.text())))
 			self.client.hostname = self.ui.line_ip.text()
 			self.client.port_com = int(self.ui.line_port_com.text())
+			self.client.port_dat = int(self.ui.line_port_dat.text())
+			# commands are queued and sent when the connection is made
 			self.client.connect_to_host_com()
-			if self.client.state >= MyClient.STATE_COM_CONNECTED:
-				self.perform_command('`ver;')
-				self.perform_command('`get-samplerate;')
-				self.perform_command('`get-ch_count;')
+			self.perform_commands(INFO_COMMANDS)
 	
 	def on_pb_data_flow_click(self):
+		if self.reconnecting:
+			self.cancel_reconnect()
+			return
 		if self.client.state >= MyClient.STATE_COM_CONNECTED:
-			if self.client.flow_is_active:
+			if self.client.flow_is_active or self.flow_pending:
 				self.flow_stop()
 			else:
 				dsp_code_text = self.ui.combo_dsp_cutoff.currentText()
 				dsp_code = int(dsp_code_text.split(':', 1)[0])
-				self.perform_command("`set-samplerate:%d;" % int(self.ui.combo_samplerate.currentText()))
-				self.perform_command("`set-low_bw:%d;" % round(float(self.ui.combo_lowpass.currentText()) * 1000))
-				self.perform_command("`set-high_bw:%d;" % int(self.ui.combo_highpass.currentText()))
-				self.perform_command("`set-dsp_en:%d;" % int(1 if self.ui.cb_dsp_enable.isChecked() else 0))
-				self.perform_command("`set-dsp_code:%d;" % dsp_code)
-				self.perform_command('`exec-apply;')
+				# only changed parameters are sent
+				self.message('<b>Applying settings</b><br>')
+				self.flow_params = settings_params(
+						self.ui.combo_samplerate.currentText(),
+						self.ui.combo_lowpass.currentText(),
+						self.ui.combo_highpass.currentText(),
+						self.ui.cb_dsp_enable.isChecked(),
+						dsp_code)
+				self.client.configure(self.flow_params)
 				
 				if self.client.state >= MyClient.STATE_COM_CONNECTED and self.client.state < MyClient.STATE_FLOW:
 					self.write_csv_flag = self.ui.cb_write_csv.isChecked()
+					self.write_raw_flag = self.ui.combo_rec_format.currentIndex() == 1
 					if self.write_csv_flag:
-						self.csvqq = Queue()
-						self.csvww = CSVWorker(self.csvqq, Path(self.ui.line_csv_dir.text()))
-						self.csvww.running = True
-						self.csvtt = QThread()
-						self.csvww.moveToThread(self.csvtt)
-						self.csvtt.started.connect(self.csvww.run)
-						self.csvww.finished.connect(self.csvtt.quit)
-						self.csvww.finished.connect(self.csvww.deleteLater)
-						self.csvtt.finished.connect(self.csvtt.deleteLater)
-						self.csvtt.start()
-					
-						self.csvqq.put(['Sample rate', self.ui.combo_samplerate.currentText()])
-						self.csvqq.put(['Low-pass',    self.ui.combo_lowpass.currentText()])
-						self.csvqq.put(['High-pass',   self.ui.combo_highpass.currentText()])
-						self.csvqq.put(['DSP enable',  self.ui.cb_dsp_enable.isChecked()])
-						self.csvqq.put(['DSP cutoff freq', dsp_code_text])
-						self.csvqq.put(["ch%d" % (i+1) for i in range(32)])
+						meta = {
+							'sample_rate' : int(self.ui.combo_samplerate.currentText()),
+							'low_pass'    : float(self.ui.combo_lowpass.currentText()),
+							'high_pass'   : int(self.ui.combo_highpass.currentText()),
+							'dsp_enable'  : self.ui.cb_dsp_enable.isChecked(),
+							'dsp_cutoff'  : dsp_code_text,
+							'channels'    : ["ch%d" % (i+1) for i in range(self.assembler.n_channels)],
+							'firmware'    : self.device_info['version'],
+						}
+						if self.ui.cb_montage_record.isChecked() and self.montage is not None:
+							self.rec_montage = self.montage
+							meta.update(montage_meta(self.rec_montage))
+						if self.write_raw_flag:
+							self.recww = RawWorker(Path(self.ui.line_csv_dir.text()), meta)
+						else:
+							self.recww = CSVWorker(Path(self.ui.line_csv_dir.text()), meta)
+						if self.recww.ofile is None:
+							self.message('<font style=\"color:#CC0000\";>Could not create file in %s</font><br>' % self.ui.line_csv_dir.text())
+						self.rectt = QThread()
+						self.recww.moveToThread(self.rectt)
+						self.rectt.started.connect(self.recww.run)
+						self.recww.finished.connect(self.rectt.quit)
+						self.recww.finished.connect(self.recww.deleteLater)
+						self.rectt.finished.connect(self.rectt.deleteLater)
+						self.rectt.start()
 
-					self.perform_command('`get-status;')
-					self.perform_command('`exec-stream_on;')
-					time.sleep(0.5)
+					self.perform_commands(STREAM_ON_COMMANDS)
+					# flow is started by on_net_state_changed when data port is connected
+					self.flow_pending = True
+					self.ui.pb_data_flow.setText('Stop')
 					self.client.connect_to_host_dat()
-					if self.client.state >= MyClient.STATE_DAT_CONNECTED:
-						self.client.flow_start()
-						self.ui.pb_data_flow.setText('Stop')
-					else:
-						self.client.disconnect_from_host()
 		else:
 			self.message('Error - device is not connected<br>')
 	
@@ -377,33 +961,54 @@ class Main_window(QMainWindow):
 					print(self.ui.messages.toPlainText().encode(sys.stdout.encoding, errors='replace'), file=log_file)
 				self.message("Log saved successfully<br>")
 	
+	def on_pb_save_trace_click(self):
+		filename, _ = QFileDialog.getSaveFileName(self, "Save trace as", 'trace.json', "Chrome trace (*.json);;All Files(*)")
+		if filename:
+			n = tracer.export(filename)
+			self.message("Trace saved: %d events<br>" % n)
+	
 	def on_pb_csv_dir_click(self):
 		dirname = QFileDialog.getExistingDirectory(self, "Select Directory")
 		if dirname:
 			self.ui.line_csv_dir.setText(dirname)
 	
-	def plots_init(self, n_plots):
-		# clear old grid layout
+	def plots_init(self, n_plots, n_samples):
+		# float, filtered data is written here as well
+		self.curvebuffers = RingBuffer(n_plots, n_samples, np.float32)
+		# spike indices are counted from the new buffer
+		self.spikes.clear()
+		if self.spike_detector is not None:
+			self.spike_detector.reset()
+		self.view_init()
+	
+	# Only the view is replaced, the data and the spikes are kept
+	@pyqtSlot()
+	def on_view_changed(self):
+		self.view_init()
+		self.plot_dirty = True
+	
+	# Plot view of the current buffers, as selected in "View"
+	def view_init(self):
+		# clear old plot view
 		while self.ui.plot_layout.count():
 			item = self.ui.plot_layout.takeAt(0)
 			widget = item.widget()
 			if widget is not None:
 				widget.setParent(None)
 		
-		self.grid = QGridLayout()
-		self.ui.plot_layout.addLayout(self.grid)
-		
-		if (n_plots == 32): width = 8
-		if (n_plots == 16): width = 4
-		n_samples = 100
-		self.curves = []
-		self.curvebuffers = np.zeros((n_plots, n_samples), dtype=np.uint16)
-		
-		for i in range(n_plots):
-			p = pg.PlotWidget()
-			p.showGrid(x = True, y = True, alpha = 1)
-			self.curves.append(p.plot(pen='b'))
-			self.grid.addWidget(p, int(i / width), int(i % width))
+		n_plots = self.curvebuffers.n_channels
+		view = self.ui.combo_view.currentIndex()
+		names = self.display_names()
+		if view == 1:
+			self.plotview = StackedPlotView(n_plots, names)
+		elif view == 2:
+			self.plotview = HeatmapView(n_plots, names)
+		elif view == 3:
+			self.plotview = SpikeRasterView(n_plots, self.spikes, names)
+		else:
+			self.plotview = GridPlotView(n_plots)
+		self.ui.plot_layout.addWidget(self.plotview, 3)
+		self.ui.plot_layout.addWidget(self.spectrumview, 1)
 
 
 class Main_app(QApplication):
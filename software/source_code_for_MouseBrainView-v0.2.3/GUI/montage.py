@@ -0,0 +1,100 @@
+#-------------------------------------------------------------------------------
+# author:	Nikita Makarevich
+# email:	nikita.makarevich@spbpu.com
+# 2021
+#-------------------------------------------------------------------------------
+# Mouse Brain View
+#-------------------------------------------------------------------------------
+# Re-referencing of the channels (montage).
+# A montage is either a reference taken from every frame (mean or median of
+# all channels, subtracted from each of them) or a matrix applied to every
+# frame: out = frame @ matrix.T, e.g. bipolar pairs ch1-ch2, ch2-ch3, ...
+# A block is processed with one numpy call into preallocated buffers.
+#-------------------------------------------------------------------------------
+
+import numpy as np
+
+class Montage:
+	# reference - 'mean' or 'median', or
+	# matrix    - (n_out, n_channels) weights
+	# names     - names of the output channels
+	def __init__(self, n_channels, reference=None, matrix=None, names=None, label=''):
+		self.n_channels = n_channels
+		self.reference = reference
+		self.matrix_t = None
+		if matrix is not None:
+			matrix = np.asarray(matrix, dtype=np.float32)
+			if matrix.ndim != 2 or matrix.shape[1] != n_channels:
+				raise ValueError('montage matrix must have %d columns, got shape %s' % (n_channels, matrix.shape))
+			self.matrix_t = np.ascontiguousarray(matrix.T)
+		self.n_out = matrix.shape[0] if matrix is not None else n_channels
+		self.names = names or ["ch%d" % (i+1) for i in range(self.n_out)]
+		self.label = label
+		self.x = np.empty((0, n_channels), dtype=np.float32)
+		self.ref = np.empty(0, dtype=np.float32)
+		self.out = np.empty((0, self.n_out), dtype=np.float32)
+
+	# Buffers grow to the largest block and are reused
+	def _buffers(self, n_rows):
+		if n_rows > len(self.x):
+			self.x = np.empty((n_rows, self.n_channels), dtype=np.float32)
+			self.ref = np.empty(n_rows, dtype=np.float32)
+			if self.matrix_t is not None:
+				self.out = np.empty((n_rows, self.n_out), dtype=np.float32)
+		return self.x[:n_rows], self.ref[:n_rows], self.out[:n_rows]
+
+	# block - (n_rows, n_channels). Returns float32 (n_rows, n_out),
+	# it is only valid until the next call.
+	def apply(self, block):
+		x, ref, out = self._buffers(len(block))
+		np.copyto(x, block)
+		if self.matrix_t is not None:
+			np.matmul(x, self.matrix_t, out=out)
+			return out
+		if self.reference == 'median':
+			np.median(x, axis=1, out=ref)
+		else:
+			np.mean(x, axis=1, out=ref)
+		x -= ref[:, None]
+		return x
+
+def common_average(n_channels):
+	return Montage(n_channels, reference='mean', label='common average')
+
+def median_reference(n_channels):
+	return Montage(n_channels, reference='median', label='median')
+
+# Neighbouring channels, ch1-ch2, ch2-ch3, ...
+def bipolar(n_channels, pairs=None):
+	if pairs is None:
+		pairs = [(i, i + 1) for i in range(n_channels - 1)]
+	matrix = np.zeros((len(pairs), n_channels), dtype=np.float32)
+	for k, (a, b) in enumerate(pairs):
+		matrix[k, a] = 1
+		matrix[k, b] = -1
+	names = ["ch%d-ch%d" % (a+1, b+1) for a, b in pairs]
+	return Montage(n_channels, matrix=matrix, names=names, label='bipolar')
+
+# Text file with a row of comma separated weights per output channel
+def load_matrix(fname, n_channels):
+	matrix = np.loadtxt(fname, delimiter=',', ndmin=2)
+	names = ["m%d" % (i+1) for i in range(matrix.shape[0])]
+	return Montage(n_channels, matrix=matrix, names=names, label=str(fname))
+
+# name - 'car', 'median', 'bipolar' or a matrix file name
+def from_name(name, n_channels):
+	if name == 'car':
+		return common_average(n_channels)
+	if name == 'median':
+		return median_reference(n_channels)
+	if name == 'bipolar':
+		return bipolar(n_channels)
+	return load_matrix(name, n_channels)
+
+# Recording settings for re-referenced data, samples are float
+def montage_meta(montage):
+	return {
+		'channels' : montage.names,
+		'dtype'    : '<f4',
+		'montage'  : montage.label,
+	}
@@ -0,0 +1,281 @@
+#-------------------------------------------------------------------------------
+# author:	Nikita Makarevich
+# email:	nikita.makarevich@spbpu.com
+# 2021
+#-------------------------------------------------------------------------------
+# Mouse Brain View
+#-------------------------------------------------------------------------------
+# Plot views for channel data.
+# Every view is a widget with set_data(curvedata, start, samplerate), where
+# curvedata has shape (n_channels, n_samples), start is the absolute index of
+# its first sample. Long windows are decimated to the plot width. With
+# samplerate the x axis is in seconds before the latest sample, otherwise
+# in samples.
+# HeatmapView and SpectrumView draw all channels as one image,
+# SpikeRasterView draws detected spikes instead of the samples.
+# ChannelQualityView is a grid of colored channel badges.
+#-------------------------------------------------------------------------------
+
+import numpy as np
+from PyQt5.QtCore import Qt, QRectF
+from PyQt5.QtWidgets import (
+	QWidget,
+	QGridLayout,
+	QLabel,
+)
+import pyqtgraph as pg
+
+from decimate import minmax_decimate
+from quality import STATE_NAMES
+
+# Width of the plot area in pixels, a guess before it is shown
+def plot_pixels(plot):
+	return max(int(plot.getViewBox().width()), 64)
+
+def time_axis(x, n_samples, samplerate):
+	if samplerate:
+		return (x - n_samples) / samplerate
+	return x
+
+def channel_names(n_plots, names=None):
+	if names is not None and len(names) == n_plots:
+		return names
+	return ["ch%d" % (j+1) for j in range(n_plots)]
+
+# Ticks at the centers of image rows, not more than about 16 labels
+def row_ticks(names):
+	step = max(1, len(names) // 16)
+	return [[(j + 0.5, names[j]) for j in range(0, len(names), step)]]
+
+# Color table for images, dark blue - low, yellow - high
+def colormap_lut():
+	pos = np.array([0.0, 0.25, 0.5, 0.75, 1.0])
+	color = np.array([
+		[ 68,   1,  84, 255],
+		[ 59,  82, 139, 255],
+		[ 33, 145, 140, 255],
+		[ 94, 201,  98, 255],
+		[253, 231,  37, 255],
+	], dtype=np.ubyte)
+	return pg.ColorMap(pos, color).getLookupTable(0.0, 1.0, 256)
+
+# Blue - below the channel mean, white - at it, red - above
+def diverging_lut():
+	pos = np.array([0.0, 0.5, 1.0])
+	color = np.array([
+		[ 33, 102, 172, 255],
+		[247, 247, 247, 255],
+		[178,  24,  43, 255],
+	], dtype=np.ubyte)
+	return pg.ColorMap(pos, color).getLookupTable(0.0, 1.0, 256)
+
+# Image levels which are not spoiled by a few outliers
+def robust_levels(image):
+	lo, hi = np.percentile(image, [5, 99.5])
+	return float(lo), float(max(hi, lo + 1e-3))
+
+# One plot widget per channel
+class GridPlotView(QWidget):
+	def __init__(self, n_plots, parent=None):
+		super(GridPlotView, self).__init__(parent)
+		self.grid = QGridLayout(self)
+		self.grid.setContentsMargins(0, 0, 0, 0)
+		width = 8 if n_plots > 16 else 4
+		self.curves = []
+		self.plots = []
+		for i in range(n_plots):
+			p = pg.PlotWidget()
+			p.showGrid(x = True, y = True, alpha = 1)
+			self.curves.append(p.plot(pen='b'))
+			self.plots.append(p)
+			self.grid.addWidget(p, int(i / width), int(i % width))
+
+	def set_data(self, curvedata, start=0, samplerate=None):
+		# all plots of the grid have the same width
+		x, y = minmax_decimate(curvedata, plot_pixels(self.plots[0]), start)
+		x = time_axis(x, curvedata.shape[1], samplerate)
+		for j in range(len(self.curves)):
+			# ===================== Warning! time-critical function! =========
+			self.curves[j].setData(x, y[j])
+			# ================================================================
+
+# All channels in one plot, one above another
+class StackedPlotView(pg.PlotWidget):
+	def __init__(self, n_plots, names=None, parent=None):
+		super(StackedPlotView, self).__init__(parent)
+		self.names = channel_names(n_plots, names)
+		self.showGrid(x = True, y = False, alpha = 1)
+		self.curves = [self.plot(pen='b') for i in range(n_plots)]
+		self.spacing = 0
+
+	def set_data(self, curvedata, start=0, samplerate=None):
+		n_plots = len(self.curves)
+		x, y = minmax_decimate(curvedata, plot_pixels(self), start)
+		x = time_axis(x, curvedata.shape[1], samplerate)
+		# Channels are centered on their mean and spaced by the largest swing,
+		# decimated data keeps the extremes, so it is enough for both
+		mean = y.mean(axis=1)
+		swing = float((y.max(axis=1) - y.min(axis=1)).max()) * 1.2
+		swing = max(swing, 1.0)
+		# Keep the spacing while the swing is comparable, to avoid jumping
+		if swing > self.spacing or swing < self.spacing / 4:
+			self.spacing = swing
+			self.getAxis('left').setTicks([[
+				((n_plots - 1 - j) * self.spacing, self.names[j]) for j in range(n_plots)
+			]])
+		for j in range(n_plots):
+			self.curves[j].setPos(0, (n_plots - 1 - j) * self.spacing - mean[j])
+			# ===================== Warning! time-critical function! =========
+			self.curves[j].setData(x, y[j])
+			# ================================================================
+
+# Channels x time image, one row per channel. Every channel is centered on its
+# mean and scaled by its standard deviation, so quiet and noisy channels
+# can be compared. The image is as wide as the plot, whatever the number
+# of channels is, and is uploaded once per update.
+class HeatmapView(pg.PlotWidget):
+	LEVEL = 3 # standard deviations at the ends of the color table
+
+	def __init__(self, n_plots, names=None, parent=None):
+		super(HeatmapView, self).__init__(parent)
+		self.n_plots = n_plots
+		self.image = pg.ImageItem()
+		self.image.setLookupTable(diverging_lut())
+		self.addItem(self.image)
+		self.getViewBox().invertY(True)
+		self.getAxis('left').setTicks(row_ticks(channel_names(n_plots, names)))
+		self.z = None # image buffer, (n_channels, n_points)
+
+	def set_data(self, curvedata, start=0, samplerate=None):
+		n_samples = curvedata.shape[1]
+		x, y = minmax_decimate(curvedata, plot_pixels(self), start)
+		mean = y.mean(axis=1, keepdims=True)
+		if y.shape[1] < n_samples:
+			# one column per bin, the extreme farther from the mean, alternating
+			# min and max columns would make stripes
+			lo = y[:, 0::2] - mean
+			hi = y[:, 1::2] - mean
+			if self.z is None or self.z.shape != lo.shape:
+				self.z = np.empty(lo.shape, dtype=np.float32)
+			z = self.z
+			np.copyto(z, lo)
+			np.copyto(z, hi, where=hi > -lo)
+		else:
+			if self.z is None or self.z.shape != y.shape:
+				self.z = np.empty(y.shape, dtype=np.float32)
+			z = self.z
+			np.subtract(y, mean, out=z)
+		scale = np.sqrt((z * z).mean(axis=1, keepdims=True))
+		z /= np.maximum(scale, 1e-6)
+		# ===================== Warning! time-critical function! =============
+		self.image.setImage(z.T, autoLevels=False, levels=(-self.LEVEL, self.LEVEL))
+		# ====================================================================
+		x0 = time_axis(0, n_samples, samplerate)
+		x1 = time_axis(n_samples, n_samples, samplerate)
+		self.image.setRect(QRectF(x0, 0, x1 - x0, self.n_plots))
+
+# A tick per spike, a row per channel, all ticks are one curve.
+# set_data() takes the plot data only for the time window, spikes come from
+# the SpikeBuffer.
+class SpikeRasterView(pg.PlotWidget):
+	def __init__(self, n_plots, spikes, names=None, parent=None):
+		super(SpikeRasterView, self).__init__(parent)
+		self.n_plots = n_plots
+		self.spikes = spikes
+		self.showGrid(x = True, y = False, alpha = 1)
+		self.getViewBox().invertY(True)
+		self.setYRange(0, n_plots, padding=0)
+		self.getAxis('left').setTicks(row_ticks(channel_names(n_plots, names)))
+		self.ticks = pg.PlotCurveItem(pen='k', connect='pairs')
+		self.addItem(self.ticks)
+
+	def set_data(self, curvedata, start=0, samplerate=None):
+		n_samples = curvedata.shape[1]
+		spikes = self.spikes.between(start, start + n_samples)
+		n = len(spikes)
+		x = np.empty(2 * n)
+		y = np.empty(2 * n)
+		x[0::2] = time_axis(spikes['index'] - start, n_samples, samplerate)
+		x[1::2] = x[0::2]
+		y[0::2] = spikes['channel'] + 0.1
+		y[1::2] = spikes['channel'] + 0.9
+		# ===================== Warning! time-critical function! =============
+		self.ticks.setData(x, y)
+		# ====================================================================
+		self.setXRange(time_axis(0, n_samples, samplerate), time_axis(n_samples, n_samples, samplerate), padding=0)
+
+# Power spectral density in dB as one image:
+# set_psd - all channels, frequency on x, channels from top to bottom;
+# set_spectrogram - one channel, time on x, frequency on y.
+class SpectrumView(pg.PlotWidget):
+	def __init__(self, parent=None):
+		super(SpectrumView, self).__init__(parent)
+		self.image = pg.ImageItem()
+		self.image.setLookupTable(colormap_lut())
+		self.addItem(self.image)
+		self.mode = None
+		self.names = None
+
+	def set_mode(self, mode, names=None):
+		if mode == self.mode and names == self.names:
+			return
+		self.mode = mode
+		self.names = names
+		left = self.getAxis('left')
+		if mode == 'psd':
+			self.setLabel('bottom', 'Frequency', 'Hz')
+			self.setLabel('left', '')
+			self.getViewBox().invertY(True)
+			left.setTicks(row_ticks(names))
+		else:
+			self.setLabel('bottom', 'Time', 's')
+			self.setLabel('left', 'Frequency', 'Hz')
+			self.getViewBox().invertY(False)
+			left.setTicks(None)
+
+	# psd_db - (n_channels, n_freqs)
+	def set_psd(self, freqs, psd_db, names=None):
+		self.set_mode('psd', channel_names(psd_db.shape[0], names))
+		df = freqs[1] - freqs[0]
+		# image is indexed [x, y]
+		self.image.setImage(psd_db.T, autoLevels=False, levels=robust_levels(psd_db))
+		self.image.setRect(QRectF(-df / 2, 0, len(freqs) * df, psd_db.shape[0]))
+
+	# spectrogram_db - (n_columns, n_freqs), the last column is the latest,
+	# period - s between the columns
+	def set_spectrogram(self, freqs, spectrogram_db, period, n_filled):
+		self.set_mode('spectrogram')
+		df = freqs[1] - freqs[0]
+		n_columns = spectrogram_db.shape[0]
+		levels = robust_levels(spectrogram_db[n_columns - max(1, min(n_filled, n_columns)):])
+		self.image.setImage(spectrogram_db, autoLevels=False, levels=levels)
+		self.image.setRect(QRectF(-n_columns * period, -df / 2, n_columns * period, len(freqs) * df))
+
+# A badge per channel colored by its state, the numbers are in the tooltip
+class ChannelQualityView(QWidget):
+	COLORS = ['#8fd18f', '#b0b0b0', '#e06060', '#f0b040'] # by quality state
+	WIDTH = 8
+
+	def __init__(self, n_plots, parent=None):
+		super(ChannelQualityView, self).__init__(parent)
+		self.grid = QGridLayout(self)
+		self.grid.setContentsMargins(0, 0, 0, 0)
+		self.grid.setSpacing(2)
+		self.badges = []
+		for i in range(n_plots):
+			badge = QLabel("%d" % (i+1))
+			badge.setAlignment(Qt.AlignCenter)
+			badge.setStyleSheet('background-color:#e0e0e0;')
+			self.badges.append(badge)
+			self.grid.addWidget(badge, i // self.WIDTH, i % self.WIDTH)
+		self.states = [None] * n_plots
+
+	# values - ChannelStats.values()
+	def set_values(self, values):
+		for j, badge in enumerate(self.badges):
+			state = int(values['state'][j])
+			if state != self.states[j]:
+				self.states[j] = state
+				badge.setStyleSheet('background-color:%s;' % self.COLORS[state])
+			badge.setToolTip('ch%d: %s<br>RMS %.1f, peak-to-peak %.0f<br>noise (MAD) %.1f, at rails %.1f%%' % (
+				j+1, STATE_NAMES[state], values['rms'][j], values['p2p'][j], values['noise'][j], values['rails'][j] * 100))
@@ -0,0 +1,101 @@
+#-------------------------------------------------------------------------------
+# author:	Nikita Makarevich
+# email:	nikita.makarevich@spbpu.com
+# 2021
+#-------------------------------------------------------------------------------
+# Mouse Brain View
+#-------------------------------------------------------------------------------
+# Signal quality of every channel over the last second.
+# Incoming rows are collected in a short bucket, a full bucket is reduced to
+# a few numbers per channel (mean, variance, min, max, MAD, samples at the
+# rails) and the last buckets are combined on request. Every sample is
+# touched once, the plot buffers are not read.
+#-------------------------------------------------------------------------------
+
+import numpy as np
+
+OK, FLAT, SATURATED, NOISY = range(4)
+STATE_NAMES = ['ok', 'flat', 'saturated', 'noisy']
+
+class ChannelStats:
+	# window        - s, statistics are over about this time
+	# flat_level    - peak-to-peak at or below it is a flat line, counts
+	# rail_fraction - more samples than this at the rails is saturation
+	# noisy_factor  - noise above this times the median noise of all channels
+	#                 is a noisy (e.g. floating) channel
+	def __init__(self, n_channels, samplerate, window=1.0, n_buckets=10,
+			flat_level=2, rail_fraction=0.01, noisy_factor=5.0, rails=(0, 65535)):
+		self.n_channels = n_channels
+		self.flat_level = flat_level
+		self.rail_fraction = rail_fraction
+		self.noisy_factor = noisy_factor
+		self.rails = rails
+		self.bucket = np.empty((max(2, int(samplerate * window / n_buckets)), n_channels), dtype=np.float32)
+		shape = (n_buckets, n_channels)
+		self.b_mean = np.zeros(shape)
+		self.b_m2 = np.zeros(shape)   # sum of squared deviations from the mean
+		self.b_min = np.zeros(shape, dtype=np.float32)
+		self.b_max = np.zeros(shape, dtype=np.float32)
+		self.b_mad = np.zeros(shape, dtype=np.float32)
+		self.b_rails = np.zeros(shape, dtype=np.int64)
+		self.reset()
+
+	def reset(self):
+		self.n_rows = 0     # rows in the current bucket
+		self.pos = 0        # next bucket to fill
+		self.n_buckets = 0  # filled buckets, up to len(b_mean)
+
+	# block - (n_rows, n_channels) as received, the rails are checked on it
+	def add(self, block):
+		size = len(self.bucket)
+		i = 0
+		while i < len(block):
+			n = min(len(block) - i, size - self.n_rows)
+			self.bucket[self.n_rows:self.n_rows + n] = block[i:i + n]
+			self.n_rows += n
+			i += n
+			if self.n_rows == size:
+				self.close_bucket()
+
+	def close_bucket(self):
+		x = self.bucket
+		k = self.pos
+		self.b_mean[k] = x.mean(axis=0, dtype=np.float64)
+		self.b_m2[k] = ((x - self.b_mean[k]) ** 2).sum(axis=0)
+		x.min(axis=0, out=self.b_min[k])
+		x.max(axis=0, out=self.b_max[k])
+		median = np.median(x, axis=0)
+		self.b_mad[k] = np.median(np.abs(x - median), axis=0)
+		self.b_rails[k] = ((x <= self.rails[0]) | (x >= self.rails[1])).sum(axis=0)
+		self.pos = (k + 1) % len(self.b_mean)
+		self.n_buckets = min(self.n_buckets + 1, len(self.b_mean))
+		self.n_rows = 0
+
+	# Statistics over the filled buckets, None before the first one.
+	# Returns dict of per channel arrays: rms (around the mean), p2p, noise
+	# (MAD / 0.6745), rails (fraction of samples at 0 or 65535) and state.
+	def values(self):
+		nb = self.n_buckets
+		if nb == 0:
+			return None
+		n = len(self.bucket)
+		mean = self.b_mean[:nb].mean(axis=0)
+		# variance of the union of equal sized buckets
+		m2 = self.b_m2[:nb].sum(axis=0) + n * ((self.b_mean[:nb] - mean) ** 2).sum(axis=0)
+		rms = np.sqrt(m2 / (n * nb))
+		p2p = self.b_max[:nb].max(axis=0) - self.b_min[:nb].min(axis=0)
+		noise = np.median(self.b_mad[:nb], axis=0) / 0.6745
+		rails = self.b_rails[:nb].sum(axis=0) / (n * nb)
+		state = np.full(self.n_channels, OK)
+		typical = np.median(noise)
+		if typical > 0:
+			state[noise > self.noisy_factor * typical] = NOISY
+		state[rails > self.rail_fraction] = SATURATED
+		state[p2p <= self.flat_level] = FLAT
+		return {
+			'rms'   : rms,
+			'p2p'   : p2p,
+			'noise' : noise,
+			'rails' : rails,
+			'state' : state,
+		}
@@ -0,0 +1,331 @@
+#-------------------------------------------------------------------------------
+# author:	Nikita Makarevich
+# email:	nikita.makarevich@spbpu.com
+# 2021
+#-------------------------------------------------------------------------------
+# Mouse Brain View
+#-------------------------------------------------------------------------------
+# Headless recorder.
+# Connects to the base station, applies settings and writes the data stream
+# to file without GUI. Settings are taken from command line arguments,
+# missing ones from autoconf.json of the GUI.
+# Example:
+#   python record.py --ip 192.168.2.213 --format raw --duration 3600
+#-------------------------------------------------------------------------------
+
+# libs
+import sys
+import os
+import signal
+import argparse
+import json
+import socket
+import time
+from datetime import datetime
+from pathlib import Path
+# Qt core only, for signals and event loop
+from PyQt5.QtCore import (
+	Qt,
+	QCoreApplication,
+	QObject,
+	QTimer,
+	QThread,
+	pyqtSlot,
+)
+# local imports
+from client import (
+	MyClient,
+	INFO_COMMANDS,
+	STREAM_ON_COMMANDS,
+	STREAM_OFF_COMMANDS,
+	RECONNECT_MIN,
+	RECONNECT_MAX,
+	RECONNECT_TIMEOUTS,
+	settings_params,
+)
+from frames import FrameAssembler
+from montage import from_name, montage_meta
+from device import DEFAULT_CH_COUNT
+from tracing import tracer
+from CSVWorker import CSVWorker
+from RawWorker import RawWorker
+
+
+def read_autoconf(fname):
+	if os.path.exists(fname):
+		with open(fname, 'r') as json_file:
+			try:
+				return json.load(json_file)
+			except:
+				print("Could not read settings file \"%s\"" % fname)
+	return {}
+
+def parse_args(argv):
+	parser = argparse.ArgumentParser(description='Record data from the base station without GUI')
+	parser.add_argument('--config', default=str(Path(__file__).parent / 'autoconf.json'),
+		help='settings file of the GUI (default: %(default)s)')
+	parser.add_argument('--ip')
+	parser.add_argument('--port-com', type=int)
+	parser.add_argument('--port-dat', type=int)
+	parser.add_argument('--dir', help='folder for the data files')
+	parser.add_argument('--format', choices=['csv', 'raw'])
+	parser.add_argument('--samplerate', type=int)
+	parser.add_argument('--lowpass', type=float, help='low-pass cutoff, Hz')
+	parser.add_argument('--highpass', type=int, help='high-pass cutoff, Hz')
+	parser.add_argument('--dsp', type=int, choices=[0, 1], help='enable DSP')
+	parser.add_argument('--dsp-code', type=int, help='DSP cutoff code, 0..15')
+	parser.add_argument('--duration', type=float, default=0, help='seconds, 0 - until Ctrl+C')
+	parser.add_argument('--trace', help='save timing of the pipeline stages to this Chrome trace JSON file at exit')
+	parser.add_argument('--reconnect', action='store_true', help='reconnect and go on recording after a connection loss')
+	parser.add_argument('--montage', help='record re-referenced data: car, median, bipolar or a matrix file')
+	args = parser.parse_args(argv)
+
+	# Missing arguments come from autoconf.json, then from the GUI defaults
+	conf = read_autoconf(args.config)
+	def pick(value, key, default):
+		return value if value is not None else conf.get(key, default)
+	args.ip         = pick(args.ip,         'line_ip',          '192.168.2.213')
+	args.port_com   = int(pick(args.port_com, 'line_port_com',  1020))
+	args.port_dat   = int(pick(args.port_dat, 'line_port_dat',  1000))
+	args.reconnect  = args.reconnect or bool(conf.get('cb_auto_reconnect', False))
+	args.dir        = Path(pick(args.dir,   'line_csv_dir',     Path(__file__).parent / "csv"))
+	args.format     = pick(args.format,     'combo_rec_format', 0)
+	if not isinstance(args.format, str):
+		args.format = 'raw' if args.format == 1 else 'csv'
+	args.samplerate = int(pick(args.samplerate, 'combo_samplerate', 1000))
+	args.lowpass    = float(pick(args.lowpass, 'combo_lowpass', 500))
+	args.highpass   = int(pick(args.highpass, 'combo_highpass', 20000))
+	args.dsp        = bool(pick(args.dsp, 'cb_dsp_enable', False))
+	if args.dsp_code is None:
+		args.dsp_code = int(str(conf.get('combo_dsp_cutoff', '0')).split(':', 1)[0])
+	# GUI montage, if it is applied to the recording there
+	if args.montage is None and conf.get('cb_montage_record', False):
+		index = int(conf.get('combo_montage', 0))
+		args.montage = [None, 'car', 'median', 'bipolar', conf.get('line_montage_file') or None][index]
+	return args
+
+
+class Recorder(QObject):
+	def __init__(self, args, parent=None):
+		super(Recorder, self).__init__(parent)
+		self.args = args
+		self.exit_code = 0
+		self.recww = None
+		self.assembler = FrameAssembler(DEFAULT_CH_COUNT)
+		self.montage = None
+		self.params = settings_params(args.samplerate, args.lowpass, args.highpass, args.dsp, args.dsp_code)
+		self.streaming = False
+		self.reconnecting = False
+		self.reconnect_delay = RECONNECT_MIN
+		self.n_timeouts = 0
+		self.t_last_data = None
+		self.gap_start = None
+
+		self.client = MyClient(self)
+		self.client.hostname = args.ip
+		self.client.port_com = args.port_com
+		self.client.port_dat = args.port_dat
+		self.client.command_signal.connect(self.on_net_command)
+		self.client.data_signal.connect(self.on_net_data)
+		self.client.connection_error_signal.connect(self.on_net_error)
+
+	def perform_commands(self, cmds):
+		for cmd in cmds:
+			print(cmd)
+		return self.client.commands(cmds)
+
+	@pyqtSlot(str)
+	def on_net_command(self, msg):
+		print(msg)
+
+	@pyqtSlot(object, float)
+	def on_net_data(self, dat, t):
+		self.t_last_data = t
+		self.n_timeouts = 0
+		t0 = tracer.begin()
+		block = self.assembler.feed(dat)
+		tracer.end('assemble', t0, len(block))
+		if len(block) and self.recww is not None:
+			if self.gap_start is not None:
+				self.add_gap(t)
+			if self.montage is not None:
+				t0 = tracer.begin()
+				block = self.montage.apply(block)
+				tracer.end('montage', t0, len(block))
+			# block is only valid during this call
+			t0 = tracer.begin()
+			self.recww.put(block.copy(), t)
+			tracer.end('record_put', t0)
+
+	@pyqtSlot(socket.error)
+	def on_net_error(self, e):
+		if type(e) is socket.timeout:
+			print('Timeout')
+			# no data for several seconds, the link is most likely gone
+			if self.args.reconnect and self.client.flow_is_active:
+				self.n_timeouts += 1
+				if self.n_timeouts >= RECONNECT_TIMEOUTS:
+					self.n_timeouts = 0
+					self.begin_reconnect()
+			return
+		print('Connection error: %s' % e)
+		if self.reconnecting:
+			# the attempt has failed, it schedules the next one itself
+			return
+		if self.args.reconnect and self.streaming:
+			self.begin_reconnect()
+			return
+		self.exit_code = 1
+		self.stop()
+
+	def start(self):
+		args = self.args
+		print('Connecting to %s:%i' % (args.ip, args.port_com))
+		# Nothing else to do until the device is set up, so wait for the replies
+		try:
+			self.client.connect_to_host_com().result()
+			self.perform_commands(INFO_COMMANDS).result()
+			self.client.configure(self.params).result()
+		except socket.error:
+			self.exit_code = 1
+			self.stop()
+			return
+
+		# Device state is filled from the replies by now
+		device = self.client.device
+		n_channels = device.ch_count or DEFAULT_CH_COUNT
+		if n_channels != self.assembler.n_channels:
+			print('Device has %d channels' % n_channels)
+			self.assembler = FrameAssembler(n_channels)
+		meta = {
+			'sample_rate' : args.samplerate,
+			'low_pass'    : args.lowpass,
+			'high_pass'   : args.highpass,
+			'dsp_enable'  : args.dsp,
+			'dsp_cutoff'  : str(args.dsp_code),
+			'channels'    : ["ch%d" % (i+1) for i in range(n_channels)],
+			'firmware'    : device.version,
+		}
+		if args.montage:
+			try:
+				self.montage = from_name(args.montage, n_channels)
+			except (OSError, ValueError) as e:
+				print('Montage: %s' % e)
+				self.exit_code = 1
+				self.stop()
+				return
+			print('Montage: %s, %d channels' % (self.montage.label, self.montage.n_out))
+			meta.update(montage_meta(self.montage))
+		if args.format == 'raw':
+			self.recww = RawWorker(args.dir, meta)
+		else:
+			self.recww = CSVWorker(args.dir, meta)
+		if self.recww.ofile is None:
+			print('Could not create file in %s' % args.dir)
+			self.exit_code = 1
+			self.client.disconnect_from_host()
+			QCoreApplication.quit()
+			return
+		self.rectt = QThread()
+		self.recww.moveToThread(self.rectt)
+		self.rectt.started.connect(self.recww.run)
+		# stop() waits for the thread, so quit it from the worker thread
+		self.recww.finished.connect(self.rectt.quit, Qt.DirectConnection)
+		self.rectt.start()
+
+		try:
+			self.perform_commands(STREAM_ON_COMMANDS).result()
+			self.client.connect_to_host_dat().result()
+		except socket.error:
+			self.exit_code = 1
+			self.stop()
+			return
+		self.assembler.reset()
+		self.client.flow_start()
+		self.streaming = True
+		print('Recording, press Ctrl+C to stop')
+		if args.duration > 0:
+			QTimer.singleShot(int(args.duration * 1000), self.stop)
+
+	# Keep the recorder and reconnect with the same settings
+	def begin_reconnect(self):
+		self.reconnecting = True
+		self.reconnect_delay = RECONNECT_MIN
+		if self.t_last_data is not None:
+			self.gap_start = (self.t_last_data, time.time() - (time.monotonic() - self.t_last_data))
+		try: self.client.disconnect_from_host().result(timeout=10)
+		except Exception: pass
+		self.schedule_reconnect()
+
+	def schedule_reconnect(self):
+		print('Reconnecting in %.1f s' % self.reconnect_delay)
+		QTimer.singleShot(int(self.reconnect_delay * 1000), self.reconnect)
+		self.reconnect_delay = min(self.reconnect_delay * 2, RECONNECT_MAX)
+
+	@pyqtSlot()
+	def reconnect(self):
+		if not self.reconnecting:
+			return
+		try:
+			self.client.connect_to_host_com().result()
+			self.perform_commands(INFO_COMMANDS).result()
+			self.client.configure(self.params).result()
+			self.perform_commands(STREAM_ON_COMMANDS).result()
+			self.client.connect_to_host_dat().result()
+		except socket.error:
+			try: self.client.disconnect_from_host().result(timeout=10)
+			except Exception: pass
+			self.schedule_reconnect()
+			return
+		print('Reconnected')
+		self.reconnecting = False
+		self.assembler.reset()
+		self.client.flow_start()
+
+	# Called with the first block after reconnect
+	def add_gap(self, t):
+		t_mono, t_wall = self.gap_start
+		self.gap_start = None
+		duration = t - t_mono
+		start = datetime.fromtimestamp(t_wall).isoformat()
+		self.recww.add_gap(start, duration, round(duration * self.args.samplerate))
+		print('Gap in recording: %.3f s' % duration)
+
+	@pyqtSlot()
+	def stop(self):
+		self.reconnecting = False
+		if self.client.state >= MyClient.STATE_COM_CONNECTED:
+			self.client.flow_stop()
+			self.perform_commands(STREAM_OFF_COMMANDS)
+		if self.recww is not None:
+			self.recww.stop()
+			self.rectt.wait()
+			print('Frames written: %d, dropped: %d' % (self.recww.n_frames, self.recww.dropped_frames))
+			clock = self.recww.clock_info()
+			if clock['effective_sample_rate'] is not None:
+				print('Effective sample rate %.3f Hz, clock drift %+.0f ppm' % (
+					clock['effective_sample_rate'], clock['clock_drift_ppm'] or 0))
+			self.recww = None
+		self.client.close()
+		if self.args.trace:
+			print('Trace saved: %d events' % tracer.export(self.args.trace))
+		QCoreApplication.quit()
+
+
+def main(argv):
+	args = parse_args(argv)
+	tracer.enable(bool(args.trace))
+	app = QCoreApplication(sys.argv[:1])
+	rec = Recorder(args)
+	# Let python handle Ctrl+C while Qt event loop is running
+	signal.signal(signal.SIGINT, lambda *a: rec.stop())
+	timer = QTimer()
+	timer.timeout.connect(lambda: None)
+	timer.start(200)
+	QTimer.singleShot(0, rec.start)
+	app.exec_()
+	return rec.exit_code
+
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
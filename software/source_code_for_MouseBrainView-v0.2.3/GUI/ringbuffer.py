@@ -0,0 +1,50 @@
+#-------------------------------------------------------------------------------
+# author:	Nikita Makarevich
+# email:	nikita.makarevich@spbpu.com
+# 2021
+#-------------------------------------------------------------------------------
+# Mouse Brain View
+#-------------------------------------------------------------------------------
+# Channel-major ring buffer for the plot data
+#-------------------------------------------------------------------------------
+
+import numpy as np
+
+# Keeps the last n_samples values of every channel.
+# Storage is twice as long as the window and every sample is written to both
+# halves, so the latest window is always one contiguous slice per channel.
+class RingBuffer:
+	def __init__(self, n_channels, n_samples, dtype=np.uint16):
+		self.n_channels = n_channels
+		self.n_samples = n_samples
+		self.data = np.zeros((n_channels, 2 * n_samples), dtype=dtype)
+		self.pos = 0
+		self.count = 0 # total number of samples written
+
+	# Write block of shape (n_rows, n_channels)
+	def write(self, block):
+		n_rows = block.shape[0]
+		self.count += n_rows
+		if n_rows >= self.n_samples:
+			block = block[-self.n_samples:]
+			n_rows = self.n_samples
+		cols = block.T
+		n = self.n_samples
+		first = min(n_rows, n - self.pos)
+		self.data[:, self.pos:self.pos + first] = cols[:, :first]
+		self.data[:, self.pos + n:self.pos + n + first] = cols[:, :first]
+		rest = n_rows - first
+		if rest > 0:
+			self.data[:, :rest] = cols[:, first:]
+			self.data[:, n:n + rest] = cols[:, first:]
+		self.pos = (self.pos + n_rows) % n
+
+	# Latest window in chronological order, shape (n_channels, n_samples).
+	# This is a view, it changes on the next write.
+	def view(self):
+		return self.data[:, self.pos:self.pos + self.n_samples]
+
+	def clear(self):
+		self.data[:] = 0
+		self.pos = 0
+		self.count = 0
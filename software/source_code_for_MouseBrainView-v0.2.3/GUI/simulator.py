@@ -0,0 +1,219 @@
+#-------------------------------------------------------------------------------
+# author:	Nikita Makarevich
+# email:	nikita.makarevich@spbpu.com
+# 2021
+#-------------------------------------------------------------------------------
+# Mouse Brain View
+#-------------------------------------------------------------------------------
+# Base station simulator.
+# Answers the command port protocol and streams synthetic signals on the data
+# port, so the GUI and the recorder can be run without hardware.
+# Example:
+#   python simulator.py --port-com 1020 --port-dat 1000 --samplerate 1000
+# and connect the GUI to 127.0.0.1.
+#-------------------------------------------------------------------------------
+
+import sys
+import socket
+import threading
+import argparse
+import random
+import time
+import numpy as np
+
+VERSION = 'HW Ver 1.0.0 FW Ver 1.0.0 simulator'
+
+# Parameters which can be read with `get-...; and written with `set-...;
+SETTABLE = ['samplerate', 'low_bw', 'high_bw', 'dsp_en', 'dsp_code']
+
+class Simulator:
+	def __init__(self, host='127.0.0.1', port_com=1020, port_dat=1000,
+			n_channels=32, samplerate=1000, chunk=1024, jitter=0.0,
+			disconnect_every=0.0, verbose=False):
+		self.host = host
+		self.n_channels = n_channels
+		self.chunk = chunk                       # bytes per send(), not aligned to frames
+		self.jitter = jitter                     # s, random delay of every send
+		self.disconnect_every = disconnect_every # s, drop data connection periodically
+		self.verbose = verbose
+
+		# settings, 'active' ones are changed by `exec-apply;
+		self.pending = {'samplerate': samplerate, 'low_bw': 500000, 'high_bw': 20000, 'dsp_en': 0, 'dsp_code': 0}
+		self.active = dict(self.pending)
+		self.streaming = False
+		self.t_start = time.monotonic()
+		self.n_sent = 0 # frames since stream start
+		self.running = False
+		self.lock = threading.Lock()
+
+		self.server_com = self.listen(port_com)
+		self.server_dat = self.listen(port_dat)
+		# actual ports, useful when 0 is given
+		self.port_com = self.server_com.getsockname()[1]
+		self.port_dat = self.server_dat.getsockname()[1]
+
+	def listen(self, port):
+		server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		server.bind((self.host, port))
+		server.listen(4)
+		return server
+
+	def log(self, s):
+		if self.verbose: print(s)
+
+	def start(self):
+		self.running = True
+		for server, handler in ((self.server_com, self.serve_com), (self.server_dat, self.serve_dat)):
+			threading.Thread(target=self.accept_loop, args=(server, handler), daemon=True).start()
+
+	def stop(self):
+		self.running = False
+		for server in (self.server_com, self.server_dat):
+			try: server.close()
+			except socket.error: pass
+
+	def accept_loop(self, server, handler):
+		while self.running:
+			try:
+				conn, addr = server.accept()
+			except socket.error:
+				break
+			self.log('connection from %s:%d' % addr)
+			threading.Thread(target=handler, args=(conn,), daemon=True).start()
+
+	#---------------------------------------------------------------------------#
+	# Command port
+	#---------------------------------------------------------------------------#
+	def serve_com(self, conn):
+		data = b''
+		with conn:
+			while self.running:
+				try:
+					rx = conn.recv(1024)
+				except socket.error:
+					break
+				if not rx:
+					break
+				data += rx
+				# commands look like `name; or `name:value;
+				while b';' in data:
+					line, data = data.split(b';', 1)
+					cmd = line.decode('ascii', 'replace').strip().lstrip('`')
+					reply = self.command(cmd)
+					self.log('%s -> %s' % (cmd, reply))
+					try:
+						conn.sendall(reply.encode('ascii'))
+					except socket.error:
+						return
+
+	def command(self, cmd):
+		with self.lock:
+			if cmd == 'ver':
+				return '>%s;' % VERSION
+			if cmd.startswith('get-'):
+				name = cmd[4:]
+				if name == 'samplerate':
+					return '>samplerate:%dHz;' % self.active['samplerate']
+				if name == 'ch_count':
+					return '>ch_count:%d;' % self.n_channels
+				if name == 'status':
+					return '>status:' + ''.join('%s:%d;' % (k, self.active[k]) for k in SETTABLE)
+				if name in SETTABLE:
+					return '>%s:%d;' % (name, self.active[name])
+				return 'parameter not found;'
+			if cmd.startswith('set-'):
+				name, _, value = cmd[4:].partition(':')
+				if name in SETTABLE:
+					try:
+						self.pending[name] = int(value)
+						return '>%s:ok;' % name
+					except ValueError:
+						pass
+				return 'parameter not found;'
+			if cmd.startswith('exec-'):
+				name = cmd[5:]
+				if name == 'apply':
+					self.active = dict(self.pending)
+				elif name == 'stream_on':
+					self.streaming = True
+				elif name == 'stream_off':
+					self.streaming = False
+				else:
+					return 'not today;'
+				return '>%s:ok;' % name
+			return 'not today;'
+
+	#---------------------------------------------------------------------------#
+	# Data port
+	#---------------------------------------------------------------------------#
+	# Synthetic signals: a slow wave and a faster oscillation with different
+	# frequency on every channel, 50 Hz line noise, white noise and rare spikes.
+	def generate(self, n0, n, fs):
+		t = (n0 + np.arange(n))[:, None] / fs
+		ch = np.arange(self.n_channels)[None, :]
+		x = 2000 * np.sin(2 * np.pi * (1 + 0.25 * ch) * t + ch)
+		x += 600 * np.sin(2 * np.pi * (8 + ch) * t)
+		x += 300 * np.sin(2 * np.pi * 50 * t)
+		x += np.random.normal(0, 100, (n, self.n_channels))
+		x[np.random.random((n, self.n_channels)) < 10 / fs] -= 4000
+		return np.clip(x + 32768, 0, 65535).astype('<u2')
+
+	def serve_dat(self, conn):
+		frame_size = self.n_channels * 2
+		t_connect = time.monotonic()
+		# samples taken while nobody was connected are lost
+		self.n_sent = max(self.n_sent, int((t_connect - self.t_start) * self.active['samplerate']))
+		pending = b''
+		with conn:
+			while self.running:
+				fs = self.active['samplerate']
+				if not self.streaming:
+					# sampling starts with `exec-stream_on;
+					self.t_start = time.monotonic()
+					self.n_sent = 0
+					time.sleep(0.01)
+					continue
+				if self.disconnect_every > 0 and time.monotonic() - t_connect > self.disconnect_every:
+					self.log('data connection dropped')
+					break
+				n_due = int((time.monotonic() - self.t_start) * fs) - self.n_sent
+				if n_due > 0:
+					pending += self.generate(self.n_sent, n_due, fs).tobytes()
+					self.n_sent += n_due
+				try:
+					while len(pending) >= self.chunk:
+						conn.sendall(pending[:self.chunk])
+						pending = pending[self.chunk:]
+				except socket.error:
+					break
+				period = self.chunk / (frame_size * fs)
+				time.sleep(max(0.001, period + random.uniform(-self.jitter, self.jitter)))
+
+
+def main(argv):
+	parser = argparse.ArgumentParser(description='Base station simulator')
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port-com', type=int, default=1020)
+	parser.add_argument('--port-dat', type=int, default=1000)
+	parser.add_argument('--channels', type=int, default=32)
+	parser.add_argument('--samplerate', type=int, default=1000, help='initial sample rate, Hz')
+	parser.add_argument('--chunk', type=int, default=1024, help='bytes per send (default: %(default)s)')
+	parser.add_argument('--jitter', type=float, default=0.0, help='random send delay, ms')
+	parser.add_argument('--disconnect-every', type=float, default=0.0, help='drop data connection every N seconds')
+	parser.add_argument('-v', '--verbose', action='store_true')
+	args = parser.parse_args(argv)
+
+	sim = Simulator(args.host, args.port_com, args.port_dat, args.channels, args.samplerate,
+		args.chunk, args.jitter / 1000, args.disconnect_every, args.verbose)
+	sim.start()
+	print('Simulator: command port %d, data port %d, %d channels' % (sim.port_com, sim.port_dat, sim.n_channels))
+	try:
+		while True:
+			time.sleep(1)
+	except KeyboardInterrupt:
+		sim.stop()
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
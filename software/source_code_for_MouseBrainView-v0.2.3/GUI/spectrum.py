@@ -0,0 +1,70 @@
+#-------------------------------------------------------------------------------
+# author:	Nikita Makarevich
+# email:	nikita.makarevich@spbpu.com
+# 2021
+#-------------------------------------------------------------------------------
+# Mouse Brain View
+#-------------------------------------------------------------------------------
+# Power spectral density of all channels.
+# Welch method: the signal is cut into overlapping segments, each segment is
+# detrended, multiplied by the Hann window and transformed. Segments of all
+# channels are strided views of the same array, so there is one rfft call
+# for the whole block.
+#-------------------------------------------------------------------------------
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+# Largest power of two not above n
+def pow2_floor(n):
+	return 1 << (max(int(n), 1).bit_length() - 1)
+
+# data     - array (n_channels, n_samples)
+# nperseg  - segment length, samples
+# Returns (freqs, psd): psd has shape (n_channels, nperseg // 2 + 1), units^2/Hz.
+def welch_psd(data, samplerate, nperseg, overlap=0.5):
+	data = np.ascontiguousarray(data, dtype=np.float32)
+	n_channels, n_samples = data.shape
+	nperseg = min(nperseg, n_samples)
+	step = max(1, int(nperseg * (1 - overlap)))
+	n_segments = (n_samples - nperseg) // step + 1
+	# latest samples are used, the oldest ones which do not fill a step are left out
+	data = data[:, n_samples - (n_segments - 1) * step - nperseg:]
+	s0, s1 = data.strides
+	segments = as_strided(data, (n_channels, n_segments, nperseg), (s0, s1 * step, s1), writeable=False)
+	window = np.hanning(nperseg + 2)[1:-1].astype(np.float32) # no zeros at the edges
+	x = segments - segments.mean(axis=2, keepdims=True)
+	x *= window
+	spectrum = np.fft.rfft(x, axis=2)
+	psd = (spectrum.real ** 2 + spectrum.imag ** 2).mean(axis=1)
+	psd /= samplerate * float((window * window).sum())
+	# one-sided, DC and Nyquist are not doubled
+	if nperseg % 2:
+		psd[:, 1:] *= 2
+	else:
+		psd[:, 1:-1] *= 2
+	freqs = np.fft.rfftfreq(nperseg, 1 / samplerate)
+	return freqs, psd
+
+# Rolling history of spectra of all channels, a fixed number of columns
+class SpectrumHistory:
+	def __init__(self, n_columns, n_channels, n_freqs):
+		self.data = np.zeros((n_columns, n_channels, n_freqs), dtype=np.float32)
+		self.pos = 0
+		self.count = 0
+
+	# psd - (n_channels, n_freqs), stored in dB
+	def add(self, psd):
+		np.log10(np.maximum(psd, 1e-20), out=self.data[self.pos])
+		self.data[self.pos] *= 10
+		self.pos = (self.pos + 1) % len(self.data)
+		self.count += 1
+
+	# Latest spectra, (n_channels, n_freqs) in dB
+	def latest(self):
+		return self.data[(self.pos - 1) % len(self.data)]
+
+	# Spectrogram of one channel, (n_columns, n_freqs), oldest column first.
+	# Columns which are not filled yet are at the start.
+	def channel(self, ch):
+		return np.roll(self.data[:, ch, :], -self.pos, axis=0)
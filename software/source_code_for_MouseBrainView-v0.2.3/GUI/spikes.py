@@ -0,0 +1,156 @@
+#-------------------------------------------------------------------------------
+# author:	Nikita Makarevich
+# email:	nikita.makarevich@spbpu.com
+# 2021
+#-------------------------------------------------------------------------------
+# Mouse Brain View
+#-------------------------------------------------------------------------------
+# Online spike detection.
+# A spike is a local peak of the signal beyond threshold * noise, where the
+# noise of every channel is MAD / 0.6745 (median absolute deviation, robust to
+# the spikes themselves). Median and MAD are taken over windows of half a
+# second and smoothed over a few seconds, so the detector follows slow
+# changes of the signal. There is no detection during the first window.
+# All channels of a block are searched at once, the last row of a block is
+# checked with the next one, when its right neighbour is known.
+#-------------------------------------------------------------------------------
+
+import numpy as np
+
+# Compact event record, index - absolute sample index
+SPIKE_DTYPE = np.dtype([
+	('index',     np.int64),
+	('channel',   np.uint16),
+	('amplitude', np.float32), # from the channel median, signal units
+])
+
+class SpikeDetector:
+	# threshold  - in noise deviations
+	# refractory - s, a peak closer than this to the previous one on the
+	#              same channel is not a new spike
+	# sign       - -1 negative peaks, 1 positive, 0 both
+	# tau        - s, time constant of the noise estimate
+	def __init__(self, n_channels, samplerate, threshold=5.0, refractory=0.002, sign=-1, tau=2.0, window=0.5):
+		self.n_channels = n_channels
+		self.samplerate = samplerate
+		self.threshold = threshold
+		self.refractory = max(1, int(round(refractory * samplerate)))
+		self.sign = sign
+		self.tau = tau
+		self.window = np.empty((max(16, int(window * samplerate)), n_channels), dtype=np.float32)
+		self.reset()
+
+	def reset(self):
+		self.center = None # per channel median
+		self.mad = None
+		self.n_window = 0  # rows in the noise window
+		self.tail = None   # last two rows of the previous block
+		self.last_peak = np.full(self.n_channels, np.iinfo(np.int64).min // 2, dtype=np.int64)
+
+	# Noise deviation per channel, None before the first window
+	def noise(self):
+		if self.mad is None:
+			return None
+		return self.mad / 0.6745
+
+	# Rows are collected in the window, the estimate is updated when it is full
+	def update_noise(self, x):
+		size = len(self.window)
+		i = 0
+		while i < len(x):
+			n = min(len(x) - i, size - self.n_window)
+			self.window[self.n_window:self.n_window + n] = x[i:i + n]
+			self.n_window += n
+			i += n
+			if self.n_window < size:
+				break
+			self.n_window = 0
+			median = np.median(self.window, axis=0)
+			mad = np.median(np.abs(self.window - median), axis=0)
+			if self.center is None:
+				self.center = median
+				self.mad = mad
+			else:
+				a = size / (size + self.tau * self.samplerate)
+				self.center += a * (median - self.center)
+				self.mad += a * (mad - self.mad)
+
+	# block - (n_rows, n_channels), start - absolute index of its first row.
+	# Returns SPIKE_DTYPE array in time order.
+	def process(self, block, start):
+		if len(block) == 0:
+			return np.empty(0, dtype=SPIKE_DTYPE)
+		x = block.astype(np.float32)
+		self.update_noise(x)
+		if self.tail is None:
+			self.tail = np.repeat(x[:1], 2, axis=0)
+		ext = np.concatenate((self.tail, x))
+		self.tail = ext[-2:].copy()
+		if self.center is None:
+			return np.empty(0, dtype=SPIKE_DTYPE)
+		ext -= self.center
+		if self.sign == 0:
+			dev = np.abs(ext)
+		else:
+			dev = ext * self.sign
+		threshold = self.threshold * self.noise()
+		# rows 1..n of ext are the previous last row and all but the last of the block
+		mid = dev[1:-1]
+		peaks = (mid > threshold) & (mid >= dev[:-2]) & (mid > dev[2:])
+		# channel major, so the previous peak of a channel is the previous element
+		channels, rows = np.nonzero(peaks.T)
+		index = start - 1 + rows
+		prev = np.empty_like(index)
+		if len(index):
+			prev[0] = self.last_peak[channels[0]]
+			same = channels[1:] == channels[:-1]
+			prev[1:] = np.where(same, index[:-1], self.last_peak[channels[1:]])
+			np.maximum.at(self.last_peak, channels, index)
+		keep = index - prev >= self.refractory
+		channels, rows, index = channels[keep], rows[keep], index[keep]
+		order = np.argsort(index, kind='stable')
+		spikes = np.empty(len(index), dtype=SPIKE_DTYPE)
+		spikes['index'] = index[order]
+		spikes['channel'] = channels[order]
+		spikes['amplitude'] = ext[rows + 1, channels][order]
+		return spikes
+
+# Last spikes in time order. Storage is twice as long and every spike is
+# written to both halves, as in RingBuffer, so the spikes are one slice.
+class SpikeBuffer:
+	def __init__(self, size=100000):
+		self.size = size
+		self.data = np.zeros(2 * size, dtype=SPIKE_DTYPE)
+		self.pos = 0
+		self.count = 0
+
+	def clear(self):
+		self.pos = 0
+		self.count = 0
+
+	def add(self, spikes):
+		n = len(spikes)
+		if n == 0:
+			return
+		self.count += n
+		if n >= self.size:
+			spikes = spikes[-self.size:]
+			n = self.size
+		first = min(n, self.size - self.pos)
+		self.data[self.pos:self.pos + first] = spikes[:first]
+		self.data[self.pos + self.size:self.pos + self.size + first] = spikes[:first]
+		rest = n - first
+		if rest > 0:
+			self.data[:rest] = spikes[first:]
+			self.data[self.size:self.size + rest] = spikes[first:]
+		self.pos = (self.pos + n) % self.size
+
+	def view(self):
+		n = min(self.count, self.size)
+		return self.data[self.pos + self.size - n:self.pos + self.size]
+
+	# Spikes with start <= index < end
+	def between(self, start, end):
+		spikes = self.view()
+		i, j = np.searchsorted(spikes['index'], [start, end])
+		return spikes[i:j]
@@ -0,0 +1,54 @@
+#-------------------------------------------------------------------------------
+# author:	Nikita Makarevich
+# email:	nikita.makarevich@spbpu.com
+# 2021
+#-------------------------------------------------------------------------------
+# Mouse Brain View
+#-------------------------------------------------------------------------------
+# Data flow counters.
+# Counters are incremented on the hot path as plain attributes, sample()
+# turns them into per second rates once in a while.
+#-------------------------------------------------------------------------------
+
+import time
+
+class FlowStats:
+	COUNTERS = [
+		'bytes',          # received from the data port
+		'chunks',
+		'frames',         # complete frames out of the assembler
+		'dropped_chunks', # not processed, e.g. on re-entry
+		'render_frames',  # plot updates
+		'render_skipped', # plot updates skipped to let ingest catch up
+		'spikes',         # detected, if the detection is on
+	]
+
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		for name in FlowStats.COUNTERS:
+			setattr(self, name, 0)
+		self.prev = dict.fromkeys(FlowStats.COUNTERS, 0)
+		self.t_prev = time.monotonic()
+		self.values = {}
+
+	# gauges - current values from other places, e.g. queue depths.
+	# Returns totals, rates as "<name>_per_s" and gauges.
+	def sample(self, **gauges):
+		now = time.monotonic()
+		dt = max(now - self.t_prev, 1e-6)
+		values = {'interval' : dt}
+		for name in FlowStats.COUNTERS:
+			total = getattr(self, name)
+			values[name] = total
+			values[name + '_per_s'] = (total - self.prev[name]) / dt
+			self.prev[name] = total
+		values.update(gauges)
+		self.t_prev = now
+		self.values = values
+		return values
+
+	# Result of the last sample()
+	def snapshot(self):
+		return dict(self.values)
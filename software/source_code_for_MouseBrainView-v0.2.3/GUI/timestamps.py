@@ -0,0 +1,82 @@
+#-------------------------------------------------------------------------------
+# author:	Nikita Makarevich
+# email:	nikita.makarevich@spbpu.com
+# 2021
+#-------------------------------------------------------------------------------
+# Mouse Brain View
+#-------------------------------------------------------------------------------
+# Sample index to host time mapping.
+# Every received chunk is stamped with time.monotonic() in the reader thread.
+# The chunk time is an upper bound for the time of its last frame, network
+# and buffering delays only make it later, so a line fitted through the
+# points gives the effective sample rate of the device clock.
+#-------------------------------------------------------------------------------
+
+import time
+
+class SampleClock:
+	# nominal_rate - configured sample rate, Hz
+	# period - s, minimal time between two points of the table
+	def __init__(self, nominal_rate=None, period=1.0):
+		self.nominal_rate = nominal_rate
+		self.period = period
+		# fixed at start, so wall clock changes do not break the mapping
+		self.wall_offset = time.time() - time.monotonic()
+		self.points = [] # (frame, monotonic time), sparse table
+		# centred sums of the finished segments
+		self.sxx = self.sxy = 0.0
+		self.dof = 0
+		self.n = 0
+		self.new_segment()
+
+	# Frame counter is not continuous over a gap, so every segment between
+	# gaps has its own offset, the slope is fitted over all of them
+	def new_segment(self):
+		if self.n > 0:
+			self.sxx += self.stt - self.st * self.st / self.n
+			self.sxy += self.stf - self.st * self.sf / self.n
+			self.dof += self.n - 1
+		self.t0 = None
+		self.f0 = 0
+		self.n = 0
+		self.st = self.sf = self.stt = self.stf = 0.0
+
+	# frame - number of frames before the end of the block, t - its monotonic time.
+	# Returns True if a point is added to the table.
+	def stamp(self, frame, t):
+		if self.n > 0 and t - self.points[-1][1] < self.period:
+			return False
+		self.points.append((frame, t))
+		# running sums relative to the segment start keep the fit O(1)
+		if self.t0 is None:
+			self.t0 = t
+			self.f0 = frame
+		x = t - self.t0
+		y = frame - self.f0
+		self.n += 1
+		self.st += x
+		self.sf += y
+		self.stt += x * x
+		self.stf += x * y
+		return True
+
+	# Frames per second of host time, None until there are enough points
+	def rate(self):
+		sxx = self.sxx
+		sxy = self.sxy
+		if self.n > 0:
+			sxx += self.stt - self.st * self.st / self.n
+			sxy += self.stf - self.st * self.sf / self.n
+		if self.dof + max(self.n - 1, 0) < 2 or sxx <= 0:
+			return None
+		return sxy / sxx
+
+	# Device clock error against the host clock, parts per million
+	def drift_ppm(self):
+		rate = self.rate()
+		if rate is None or not self.nominal_rate:
+			return None
+		return (rate / self.nominal_rate - 1) * 1e6
+
+	def wall_time(self, t):
+		return t + self.wall_offset
@@ -0,0 +1,92 @@
+#-------------------------------------------------------------------------------
+# author:	Nikita Makarevich
+# email:	nikita.makarevich@spbpu.com
+# 2021
+#-------------------------------------------------------------------------------
+# Mouse Brain View
+#-------------------------------------------------------------------------------
+# Timing spans of the data pipeline.
+# Spans are kept in a ring of the last events and can be saved as Chrome
+# trace-event JSON (chrome://tracing, https://ui.perfetto.dev).
+# Usage:
+#   t0 = tracer.begin()
+#   ...
+#   tracer.end('stage', t0)
+# When tracing is off begin() returns None and end() does nothing.
+#-------------------------------------------------------------------------------
+
+import os
+import json
+import threading
+import itertools
+from time import perf_counter
+
+class Tracer:
+	def __init__(self, size=100000):
+		self.size = size
+		self.enabled = False
+		self.thread_names = {threading.main_thread().ident : 'main'}
+		self.clear()
+
+	def clear(self):
+		self.events = [None] * self.size
+		# next() of itertools.count is atomic, spans come from several threads
+		self.seq = itertools.count()
+		self.n_events = 0
+
+	def enable(self, on=True):
+		self.enabled = on
+
+	# Called at the start of a thread, Qt threads are not known to threading
+	def set_thread_name(self, name):
+		self.thread_names[threading.get_ident()] = name
+
+	def begin(self):
+		if self.enabled:
+			return perf_counter()
+		return None
+
+	# n - optional number of items processed, e.g. frames
+	def end(self, name, t0, n=None):
+		if t0 is None:
+			return
+		t1 = perf_counter()
+		i = next(self.seq)
+		self.events[i % self.size] = (name, threading.get_ident(), t0, t1, n)
+		self.n_events = i + 1
+
+	# Events in time order, oldest first
+	def spans(self):
+		n = self.n_events
+		if n <= self.size:
+			events = self.events[:n]
+		else:
+			i = n % self.size
+			events = self.events[i:] + self.events[:i]
+		return sorted([e for e in events if e is not None], key=lambda e: e[2])
+
+	def export(self, fname):
+		pid = os.getpid()
+		spans = self.spans()
+		trace = []
+		for tid in sorted(set(e[1] for e in spans)):
+			trace.append({'name' : 'thread_name', 'ph' : 'M', 'pid' : pid, 'tid' : tid,
+				'args' : {'name' : self.thread_names.get(tid, str(tid))}})
+		for name, tid, t0, t1, n in spans:
+			event = {
+				'name' : name,
+				'ph'   : 'X',
+				'pid'  : pid,
+				'tid'  : tid,
+				'ts'   : round(t0 * 1e6, 3),
+				'dur'  : round((t1 - t0) * 1e6, 3),
+			}
+			if n is not None:
+				event['args'] = {'n' : n}
+			trace.append(event)
+		with open(fname, 'w') as json_file:
+			json.dump({'traceEvents' : trace, 'displayTimeUnit' : 'ms'}, json_file)
+		return len(trace)
+
+# One tracer for the whole program
+tracer = Tracer()